@@ -1,19 +1,480 @@
 import random
-from collections import defaultdict
+import threading
+from collections.abc import Mapping
 
 import numpy as np
 import pandas as pd
 
+from loyalty_results import (
+    RESULT_COLUMNS,
+    ResultsWriter,
+    aggregate_results_directory,
+    aggregate_results_frame,
+    is_results_directory,
+)
+
+SEGMENTS = ["high_value", "purchaser", "engaged", "new"]
+SEGMENT_INDEX = {segment: i for i, segment in enumerate(SEGMENTS)}
+
+USER_WEIGHT = 0.6
+SEGMENT_WEIGHT = 0.3
+GLOBAL_WEIGHT = 0.1
+
+# Challenge selection policies of ChallengeRecommendationSystem
+POLICIES = ["epsilon_greedy", "ucb1", "thompson_beta", "thompson_gaussian"]
+# Width of the UCB1 confidence bonus
+UCB_EXPLORATION = 1.0
+# Largest reward calculate_reward can give, maps rewards onto [0, 1] for the
+# Beta posteriors of thompson_beta
+REWARD_SCALE = 8.0
+# Reward noise assumed by thompson_gaussian
+GAUSSIAN_REWARD_STD = 1.0
+
+
+def segment_codes(lifetime_purchases, reviews_written):
+    """Map purchase/review count arrays to indices into SEGMENTS"""
+    lifetime_purchases = np.asarray(lifetime_purchases)
+    reviews_written = np.asarray(reviews_written)
+    return np.select(
+        [lifetime_purchases > 3, lifetime_purchases > 0, reviews_written > 0],
+        [
+            SEGMENT_INDEX["high_value"],
+            SEGMENT_INDEX["purchaser"],
+            SEGMENT_INDEX["engaged"],
+        ],
+        default=SEGMENT_INDEX["new"],
+    )
+
+
+def user_columns(users):
+    """
+    Split a batch of users into column arrays.
+
+    Args:
+        users: DataFrame or list of user dicts
+
+    Returns:
+        tuple: (user_ids, lifetime_purchases, reviews_written)
+    """
+    if isinstance(users, pd.DataFrame):
+        return (
+            users["user_id"].tolist(),
+            users["lifetime_purchases"].to_numpy(),
+            users["reviews_written"].to_numpy(),
+        )
+
+    return (
+        [user["user_id"] for user in users],
+        np.array([user["lifetime_purchases"] for user in users]),
+        np.array([user["reviews_written"] for user in users]),
+    )
+
+
+def segment_users(users):
+    """
+    Segment codes (indices into SEGMENTS) for a whole user table at once.
+
+    Args:
+        users: DataFrame, list of user dicts or UserState
+
+    Returns:
+        np.ndarray: Segment code per user, in input order
+    """
+    if isinstance(users, UserState):
+        return users.segment.astype(np.intp)
+    if isinstance(users, pd.DataFrame):
+        return segment_codes(users["lifetime_purchases"], users["reviews_written"])
+
+    return segment_codes(
+        [user["lifetime_purchases"] for user in users],
+        [user["reviews_written"] for user in users],
+    )
+
+
+def top_k_indices(scores, k):
+    """
+    Indices of the k highest scores in descending order, ties broken by
+    lower index (as a stable sort would), using O(n) partial selection.
+    """
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    kth_score = -np.partition(-scores, k - 1)[k - 1]
+    above = np.flatnonzero(scores > kth_score)
+    tied = np.flatnonzero(scores == kth_score)[: k - len(above)]
+    selected = np.concatenate([above, tied])
+
+    return selected[np.argsort(-scores[selected], kind="stable")]
+
+
+def apply_ema_updates(values, keys, rewards, alpha):
+    """
+    Apply a stream of exponential-moving-average updates in closed form.
+
+    Updating values[key] with rewards r_1..r_k one at a time gives
+    (1 - alpha)^k * q_0 + sum_j alpha * (1 - alpha)^(k - j) * r_j,
+    so each key is updated once with its group's decayed reward sum.
+
+    Args:
+        values: 1-D float array updated in place
+        keys: Index into values per event, in arrival order
+        rewards: Reward per event
+        alpha: Learning rate
+    """
+    keys = np.asarray(keys)
+    if keys.size == 0:
+        return
+
+    rewards = np.asarray(rewards, dtype=float)
+    decay = 1 - alpha
+
+    order = np.argsort(keys, kind="stable")
+    unique_keys, starts, counts = np.unique(
+        keys[order], return_index=True, return_counts=True
+    )
+    position = np.arange(keys.size) - np.repeat(starts, counts)
+    remaining = np.repeat(counts, counts) - position - 1
+
+    decayed_rewards = np.add.reduceat(alpha * decay**remaining * rewards[order], starts)
+    values[unique_keys] = decay**counts * values[unique_keys] + decayed_rewards
+
+
+class UserQTable:
+    """Dense users x challenges Q-value matrix with a user_id -> row index"""
+
+    def __init__(self, num_challenges, initial_capacity=1024):
+        self.index = {}
+        self.values = np.zeros((initial_capacity, num_challenges))
+        self._allocation_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def row(self, user_id):
+        """Return the Q-value row of a known user, or None"""
+        idx = self.index.get(user_id)
+        if idx is None:
+            return None
+        return self.values[idx]
+
+    def ensure(self, user_id):
+        """Return the row index of a user, allocating a zero row if unseen"""
+        idx = self.index.get(user_id)
+        if idx is None:
+            with self._allocation_lock:
+                idx = self.index.get(user_id)
+                if idx is None:
+                    idx = len(self.index)
+                    if idx == len(self.values):
+                        self._grow(idx + 1)
+                    self.index[user_id] = idx
+        return idx
+
+    def find_many(self, user_ids):
+        """Return row indices for a sequence of users, -1 for unseen ones"""
+        return np.fromiter(
+            (self.index.get(user_id, -1) for user_id in user_ids),
+            dtype=np.intp,
+            count=len(user_ids),
+        )
+
+    def ensure_many(self, user_ids):
+        """Return row indices for a sequence of users, allocating unseen ones"""
+        return np.fromiter(
+            (self.ensure(user_id) for user_id in user_ids),
+            dtype=np.intp,
+            count=len(user_ids),
+        )
+
+    def values_of(self, user_ids):
+        """Copy of the Q-value rows of a sequence of users, zeros for unseen ones"""
+        return self.gather(self.find_many(user_ids))
+
+    def gather(self, rows):
+        """Copy of the Q-value rows at row indices, zeros for rows of -1"""
+        rows = np.asarray(rows, dtype=np.intp)
+        values = self.values[rows]
+        values[rows < 0] = 0
+        return values
+
+    def update(self, rows, challenge_idx, rewards, alpha):
+        """
+        Apply EMA updates to (row, challenge) pairs in order, see
+        apply_ema_updates. Events with a row of -1 are skipped.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        challenge_idx = np.asarray(challenge_idx, dtype=np.intp)
+        known = rows >= 0
+        apply_ema_updates(
+            self.values.reshape(-1),
+            rows[known] * self.values.shape[1] + challenge_idx[known],
+            np.asarray(rewards, dtype=float)[known],
+            alpha,
+        )
+
+    def _grow(self, min_rows):
+        capacity = max(min_rows, 2 * len(self.values))
+        values = np.zeros((capacity, self.values.shape[1]))
+        values[: len(self.values)] = self.values
+        self.values = values
+
+
+class SparseUserQTable(UserQTable):
+    """
+    User Q-values stored only for touched (user, challenge) pairs.
+
+    Pairs are packed as sorted flat keys (row * num_challenges + challenge)
+    with a parallel value array, 16 bytes per touched pair instead of a full
+    row per user. Newly touched pairs collect in a small dict that is merged
+    into the packed arrays once it outgrows merge_threshold.
+    """
+
+    def __init__(self, num_challenges, merge_threshold=65536):
+        self.index = {}
+        self.num_challenges = num_challenges
+        self.merge_threshold = merge_threshold
+        self.keys = np.empty(0, dtype=np.int64)
+        self.data = np.empty(0)
+        self._pending = {}
+        self._allocation_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def nnz(self):
+        """Number of stored (user, challenge) pairs"""
+        return len(self.keys) + len(self._pending)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.data.nbytes + 16 * len(self._pending)
+
+    def row(self, user_id):
+        """Return a copy of the Q-value row of a known user, or None"""
+        idx = self.index.get(user_id)
+        if idx is None:
+            return None
+        return self.gather([idx])[0]
+
+    def ensure(self, user_id):
+        idx = self.index.get(user_id)
+        if idx is None:
+            with self._allocation_lock:
+                idx = self.index.setdefault(user_id, len(self.index))
+        return idx
+
+    def gather(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        num_challenges = self.num_challenges
+        values = np.zeros((len(rows), num_challenges))
+
+        with self._lock:
+            keys, data = self.keys, self.data
+            pending = list(self._pending.items())
+
+        # Expand each requested row's contiguous run of packed pairs
+        known = np.flatnonzero(rows >= 0)
+        starts = np.searchsorted(keys, rows[known] * num_challenges)
+        counts = np.searchsorted(keys, (rows[known] + 1) * num_challenges) - starts
+        if counts.any():
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            positions = np.repeat(starts, counts) + offsets
+            values[np.repeat(known, counts), keys[positions] % num_challenges] = data[
+                positions
+            ]
+
+        if pending and len(known):
+            pending_keys = np.fromiter((k for k, _ in pending), dtype=np.int64)
+            pending_values = np.fromiter((v for _, v in pending), dtype=float)
+            order = known[np.argsort(rows[known], kind="stable")]
+            sorted_rows = rows[order]
+            pending_rows = pending_keys // num_challenges
+            lo = np.searchsorted(sorted_rows, pending_rows, side="left")
+            counts = np.searchsorted(sorted_rows, pending_rows, side="right") - lo
+            offsets = np.arange(counts.sum()) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            values[
+                order[np.repeat(lo, counts) + offsets],
+                np.repeat(pending_keys % num_challenges, counts),
+            ] = np.repeat(pending_values, counts)
+
+        return values
+
+    def update(self, rows, challenge_idx, rewards, alpha):
+        rows = np.asarray(rows, dtype=np.int64)
+        challenge_idx = np.asarray(challenge_idx, dtype=np.int64)
+        known = rows >= 0
+        keys = rows[known] * self.num_challenges + challenge_idx[known]
+        if keys.size == 0:
+            return
+
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        with self._lock:
+            positions = np.searchsorted(self.keys, unique_keys)
+            packed = positions < len(self.keys)
+            packed[packed] = self.keys[positions[packed]] == unique_keys[packed]
+
+            current = np.zeros(len(unique_keys))
+            current[packed] = self.data[positions[packed]]
+            new = np.flatnonzero(~packed)
+            if self._pending:
+                current[new] = [
+                    self._pending.get(key, 0.0) for key in unique_keys[new].tolist()
+                ]
+
+            apply_ema_updates(
+                current, inverse, np.asarray(rewards, dtype=float)[known], alpha
+            )
+
+            self.data[positions[packed]] = current[packed]
+            if len(self._pending) + len(new) > self.merge_threshold:
+                self._merge(unique_keys[new], current[new])
+            else:
+                self._pending.update(
+                    zip(unique_keys[new].tolist(), current[new].tolist())
+                )
+
+    def packed(self):
+        """Sorted keys and values of every stored pair, pending ones included"""
+        with self._lock:
+            pending_keys = np.fromiter(self._pending, dtype=np.int64)
+            pending_values = np.fromiter(self._pending.values(), dtype=float)
+            keys = np.concatenate([self.keys, pending_keys])
+            data = np.concatenate([self.data, pending_values])
+        order = np.argsort(keys, kind="stable")
+        return keys[order], data[order]
+
+    def _merge(self, new_keys, new_values):
+        """Pack the pending pairs, superseded by new_keys, into the sorted arrays"""
+        pending_keys = np.fromiter(self._pending, dtype=np.int64)
+        pending_values = np.fromiter(self._pending.values(), dtype=float)
+        # new_keys is sorted (from np.unique), so membership is a binary search
+        found = np.searchsorted(new_keys, pending_keys)
+        kept = np.ones(len(pending_keys), dtype=bool)
+        if len(new_keys):
+            kept = new_keys[np.minimum(found, len(new_keys) - 1)] != pending_keys
+
+        keys = np.concatenate([self.keys, pending_keys[kept], new_keys])
+        data = np.concatenate([self.data, pending_values[kept], new_values])
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.data = keys[order], data[order]
+        self._pending = {}
+
+
+class _UserQValuesView(Mapping):
+    """Read-only {user_id: {challenge: q_value}} view over a UserQTable"""
+
+    def __init__(self, table, challenge_names):
+        self._table = table
+        self._challenge_names = challenge_names
+
+    def __getitem__(self, user_id):
+        row = self._table.row(user_id)
+        if row is None:
+            raise KeyError(user_id)
+        return dict(zip(self._challenge_names, row.tolist()))
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)
+
+
+class ChallengeCatalog:
+    """
+    Challenge definitions interned to integer ids (their definition order),
+    with the per-challenge attributes used on hot paths precomputed as arrays.
+    """
+
+    def __init__(self, challenges):
+        self.challenges = challenges
+        self.names = list(challenges)
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+        self.max_progress = np.array(
+            [challenges[name]["max_progress"] for name in self.names], dtype=np.int8
+        )
+        self.is_purchase = np.array(["Purchase" in name for name in self.names])
+        self.is_review = np.array(["review" in name.lower() for name in self.names])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, challenge):
+        try:
+            self.id_of(challenge)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def id_of(self, challenge):
+        """Integer id of a challenge given by name or id, KeyError if unknown"""
+        if isinstance(challenge, (int, np.integer)) and not isinstance(challenge, bool):
+            if not 0 <= challenge < len(self.names):
+                raise KeyError(challenge)
+            return int(challenge)
+        return self.index[challenge]
+
+    def ids_of(self, challenges):
+        """Integer ids of a sequence of challenges given by name or id"""
+        return np.fromiter(
+            (self.id_of(challenge) for challenge in challenges),
+            dtype=np.intp,
+            count=len(challenges),
+        )
+
+    def ids_or_none(self, challenges):
+        """
+        Integer ids of challenges given as an id array (-1 for none) or a
+        sequence of names/ids with None for none.
+        """
+        challenges = np.asarray(challenges)
+        if challenges.dtype.kind in "iu":
+            return challenges.astype(np.intp, copy=False)
+        return np.fromiter(
+            (-1 if c is None else self.id_of(c) for c in challenges.tolist()),
+            dtype=np.intp,
+            count=len(challenges),
+        )
+
+    def name_of(self, challenge):
+        """Name of a challenge given by name or id"""
+        return self.names[self.id_of(challenge)]
+
 
 class ChallengeRecommendationSystem:
-    def __init__(self, exploration_rate=0.1):
+    def __init__(
+        self, exploration_rate=0.1, learning_rate=0.1, policy="epsilon_greedy"
+    ):
         """
         Initialize the recommendation system.
 
         Args:
-            exploration_rate: Probability of exploring rather than exploiting
+            exploration_rate: Probability of exploring rather than exploiting,
+                used by the epsilon_greedy policy
+            learning_rate: Step size of the Q-value moving averages
+            policy: Challenge selection policy, one of POLICIES
         """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, expected one of {POLICIES}")
+
         self.exploration_rate = exploration_rate
+        self.learning_rate = learning_rate
+        self.policy = policy
 
         self.challenges = {
             "First Purchase": {
@@ -66,13 +527,82 @@ class ChallengeRecommendationSystem:
             },
         }
 
-        self.challenge_q_values = {challenge: 0.0 for challenge in self.challenges}
-        self.user_challenge_q_values = {}
+        self.catalog = ChallengeCatalog(self.challenges)
+        self.challenge_names = self.catalog.names
+        self.challenge_index = self.catalog.index
+        num_challenges = len(self.catalog)
+
+        # Q-tables: challenges, segments x challenges and users x challenges
+        self.global_q = np.zeros(num_challenges)
+        self.segment_q = np.zeros((len(SEGMENTS), num_challenges))
+        self.user_q = UserQTable(num_challenges)
+        self.segments_seen = np.zeros(len(SEGMENTS), dtype=bool)
+
+        # Optional sink with record(user_ids, segments, challenges, rewards)
+        self.update_log = None
+
+        # Change counters of the global row (0) and segment rows (1 + segment),
+        # keying the cached rankings below
+        self.q_versions = np.zeros(1 + len(SEGMENTS), dtype=np.int64)
+        self._ranking_cache = {}
+
+        # Simulated attempts and completions per challenge id
+        self.attempt_counts = np.zeros(num_challenges, dtype=np.int64)
+        self.completion_counts = np.zeros(num_challenges, dtype=np.int64)
+
+        # Updates and reward sums per segment and challenge, the statistics
+        # behind the UCB1 and Thompson sampling policies
+        self.pull_counts = np.zeros((len(SEGMENTS), num_challenges), dtype=np.int64)
+        self.reward_sums = np.zeros((len(SEGMENTS), num_challenges))
+
+    @property
+    def challenge_attempts(self):
+        """Attempt counts as a {challenge: count} dict"""
+        return dict(zip(self.challenge_names, self.attempt_counts.tolist()))
+
+    @property
+    def challenge_completions(self):
+        """Completion counts as a {challenge: count} dict"""
+        return dict(zip(self.challenge_names, self.completion_counts.tolist()))
+
+    @property
+    def challenge_q_values(self):
+        """Global Q-values as a {challenge: q_value} dict"""
+        return dict(zip(self.challenge_names, self.global_q.tolist()))
+
+    @property
+    def segment_preferences(self):
+        """Segment Q-values as a {segment: {challenge: q_value}} dict"""
+        return {
+            segment: dict(zip(self.challenge_names, self.segment_q[i].tolist()))
+            for i, segment in enumerate(SEGMENTS)
+            if self.segments_seen[i]
+        }
+
+    @property
+    def user_challenge_q_values(self):
+        """User Q-values as a read-only {user_id: {challenge: q_value}} mapping"""
+        return _UserQValuesView(self.user_q, self.challenge_names)
 
-        self.challenge_completions = {challenge: 0 for challenge in self.challenges}
-        self.challenge_attempts = {challenge: 0 for challenge in self.challenges}
+    def combined_scores(self, user_id, user_segment):
+        """
+        Score every challenge for a user in one vectorized expression.
+
+        Args:
+            user_id: User identifier, scored with zero Q-values if unseen
+            user_segment: Segment name of the user
 
-        self.segment_preferences = defaultdict(lambda: defaultdict(float))
+        Returns:
+            np.ndarray: Combined score per challenge, in challenge_names order
+        """
+        segment_idx = SEGMENT_INDEX[user_segment]
+        self.segments_seen[segment_idx] = True
+
+        return (
+            USER_WEIGHT * self.user_q.values_of([user_id])[0]
+            + SEGMENT_WEIGHT * self.segment_q[segment_idx]
+            + GLOBAL_WEIGHT * self.global_q
+        )
 
     def get_user_segment(self, user):
         """Determine user segment based on user data"""
@@ -87,7 +617,7 @@ class ChallengeRecommendationSystem:
 
     def select_challenge(self, user):
         """
-        Select a challenge for a user using epsilon-greedy strategy.
+        Select a challenge for a user using the instance's policy.
 
         Args:
             user: User data
@@ -98,30 +628,133 @@ class ChallengeRecommendationSystem:
         user_id = user["user_id"]
         user_segment = self.get_user_segment(user)
 
-        if user_id not in self.user_challenge_q_values:
-            self.user_challenge_q_values[user_id] = {
-                challenge: 0.0 for challenge in self.challenges
-            }
+        if self.policy != "epsilon_greedy":
+            selected = self.select_from_user_values(
+                self.user_q.values_of([user_id]),
+                np.array([SEGMENT_INDEX[user_segment]]),
+            )
+            return self.challenge_names[int(selected[0])]
 
         if np.random.random() < self.exploration_rate:
-            return np.random.choice(list(self.challenges.keys()))
-
-        combined_q_values = {}
-        for challenge in self.challenges:
-            user_specific_weight = 0.6
-            segment_weight = 0.3
-            global_weight = 0.1
-
-            combined_value = (
-                user_specific_weight * self.user_challenge_q_values[user_id][challenge]
-                + segment_weight * self.segment_preferences[user_segment][challenge]
-                + global_weight * self.challenge_q_values[challenge]
-            )
+            return self.challenge_names[np.random.randint(len(self.challenge_names))]
 
-            combined_q_values[challenge] = combined_value
+        combined_q_values = self.combined_scores(user_id, user_segment)
+        return self.challenge_names[int(np.argmax(combined_q_values))]
+
+    def select_challenges_batch(self, users, rng=None):
+        """
+        Select challenges for many users in one vectorized pass.
 
-        best_challenge = max(combined_q_values.items(), key=lambda x: x[1])[0]
-        return best_challenge
+        Args:
+            users: DataFrame or list of user dicts
+            rng: Optional np.random.Generator, defaults to the global NumPy RNG
+
+        Returns:
+            list: Selected challenge name per user, in input order
+        """
+        user_ids, lifetime_purchases, reviews_written = user_columns(users)
+
+        selected = self.select_from_user_values(
+            self.user_q.values_of(user_ids),
+            segment_codes(lifetime_purchases, reviews_written),
+            rng,
+        )
+
+        return [self.challenge_names[i] for i in selected]
+
+    def select_challenge_indices(self, user_rows, segments, rng=None):
+        """
+        Select challenges over user Q-rows and segment codes.
+
+        Args:
+            user_rows: Row index into user_q per user
+            segments: Index into SEGMENTS per user
+            rng: Optional np.random.Generator, defaults to the global NumPy RNG
+
+        Returns:
+            np.ndarray: Selected challenge index per user
+        """
+        return self.select_from_user_values(
+            self.user_q.gather(user_rows), segments, rng
+        )
+
+    def select_from_user_values(self, user_values, segments, rng=None):
+        """
+        Select challenges over user Q-value rows and segment codes with the
+        instance's policy.
+
+        Args:
+            user_values: users x challenges user Q-values
+            segments: Index into SEGMENTS per user
+            rng: Optional np.random.Generator, defaults to the global NumPy RNG
+
+        Returns:
+            np.ndarray: Selected challenge index per user
+        """
+        if self.policy != "epsilon_greedy":
+            self.segments_seen[np.unique(segments)] = True
+            return np.argmax(self.policy_scores(user_values, segments, rng), axis=1)
+
+        num_users = len(user_values)
+        num_challenges = len(self.challenge_names)
+
+        if rng is None:
+            explore = np.random.random(num_users) < self.exploration_rate
+            random_choices = np.random.randint(num_challenges, size=num_users)
+        else:
+            explore = rng.random(num_users) < self.exploration_rate
+            random_choices = rng.integers(num_challenges, size=num_users)
+
+        self.segments_seen[np.unique(segments[~explore])] = True
+
+        combined_q_values = (
+            USER_WEIGHT * user_values
+            + SEGMENT_WEIGHT * self.segment_q[segments]
+            + GLOBAL_WEIGHT * self.global_q
+        )
+        return np.where(explore, random_choices, np.argmax(combined_q_values, axis=1))
+
+    def policy_scores(self, user_values, segments, rng=None):
+        """
+        Score challenges under the UCB1 or Thompson sampling policy.
+
+        The segment term of the combined score gets the policy's exploration:
+        ucb1 adds a confidence bonus from the segment's update counts (untried
+        challenges score infinite), thompson_beta replaces it with a draw from
+        a Beta posterior over scaled rewards, and thompson_gaussian draws it
+        around the segment Q-value with a spread shrinking with its updates.
+
+        Args:
+            user_values: users x challenges user Q-values
+            segments: Index into SEGMENTS per user
+            rng: Optional np.random.Generator, defaults to the global NumPy RNG
+
+        Returns:
+            np.ndarray: users x challenges scores, argmax is the selection
+        """
+        rng = np.random if rng is None else rng
+        pulls = self.pull_counts[segments]
+        scores = USER_WEIGHT * user_values + GLOBAL_WEIGHT * self.global_q
+
+        if self.policy == "ucb1":
+            total_pulls = np.maximum(pulls.sum(axis=1, keepdims=True), 1)
+            bonus = UCB_EXPLORATION * np.sqrt(
+                2 * np.log(total_pulls) / np.maximum(pulls, 1)
+            )
+            segment_scores = self.segment_q[segments] + np.where(
+                pulls > 0, bonus, np.inf
+            )
+        elif self.policy == "thompson_beta":
+            successes = np.clip(self.reward_sums[segments] / REWARD_SCALE, 0, pulls)
+            segment_scores = REWARD_SCALE * rng.beta(
+                1 + successes, 1 + pulls - successes
+            )
+        else:
+            segment_scores = self.segment_q[segments] + rng.standard_normal(
+                pulls.shape
+            ) * (GAUSSIAN_REWARD_STD / np.sqrt(pulls + 1))
+
+        return scores + SEGMENT_WEIGHT * segment_scores
 
     def simulate_user_interaction(self, user, challenge):
         """
@@ -129,7 +762,7 @@ class ChallengeRecommendationSystem:
 
         Args:
             user: User data
-            challenge: Challenge to simulate
+            challenge: Challenge name or id to simulate
 
         Returns:
             tuple: (progress, completed, purchase, review)
@@ -137,6 +770,9 @@ class ChallengeRecommendationSystem:
         if challenge is None:
             return 0, False, False, False
 
+        challenge_id = self.catalog.id_of(challenge)
+        max_progress = int(self.catalog.max_progress[challenge_id])
+
         base_progress = 1
         purchase_prob = 0.1
         review_prob = 0.1
@@ -151,21 +787,19 @@ class ChallengeRecommendationSystem:
         elif segment == "engaged":
             review_prob = 0.25
 
-        if "Purchase" in challenge:
+        if self.catalog.is_purchase[challenge_id]:
             purchase_prob *= 2
-        elif "Review" in challenge:
+        elif self.catalog.is_review[challenge_id]:
             review_prob *= 2
 
-        progress = min(base_progress, self.challenges[challenge]["max_progress"])
-        completed = (user["challenge_progress"] + progress) >= self.challenges[
-            challenge
-        ]["max_progress"]
+        progress = min(base_progress, max_progress)
+        completed = (user["challenge_progress"] + progress) >= max_progress
         purchase_made = np.random.random() < purchase_prob
         review_written = np.random.random() < review_prob
 
-        self.challenge_attempts[challenge] += 1
+        self.attempt_counts[challenge_id] += 1
         if completed:
-            self.challenge_completions[challenge] += 1
+            self.completion_counts[challenge_id] += 1
 
         return progress, completed, purchase_made, review_written
 
@@ -178,7 +812,7 @@ class ChallengeRecommendationSystem:
 
         Args:
             user: User data
-            challenge: The challenge being evaluated
+            challenge: Name or id of the challenge being evaluated
             completed: Whether the challenge was completed
             purchase_made: Whether a purchase was made
             review_written: Whether a review was written
@@ -207,7 +841,10 @@ class ChallengeRecommendationSystem:
 
             base_reward += review_reward + length_bonus
 
-        if challenge is not None and "review" in challenge.lower():
+        if (
+            challenge is not None
+            and self.catalog.is_review[self.catalog.id_of(challenge)]
+        ):
             if review_written:
                 base_reward += 1.0
 
@@ -219,17 +856,51 @@ class ChallengeRecommendationSystem:
 
                 base_reward += challenge_length_bonus
 
-        user_segment = self.get_user_segment(user)
-
         return base_reward
 
-    def update_q_values(self, user, challenge, reward, completed):
+    def calculate_rewards(
+        self, challenges, completed, purchase_made, review_written, review_length=None
+    ):
+        """
+        Calculate rewards for many interactions at once, equal to calling
+        calculate_reward for each event.
+
+        Args:
+            challenges: Challenge id array (-1 for none), or names/ids/None
+            completed: Whether each challenge was completed
+            purchase_made: Whether each interaction made a purchase
+            review_written: Whether each interaction wrote a review
+            review_length: Review length per event, defaults to 0
+
+        Returns:
+            np.ndarray: Reward per event
+        """
+        challenges = self.catalog.ids_or_none(challenges)
+        review_written = np.asarray(review_written, dtype=bool)
+        if review_length is None:
+            review_length = np.zeros(len(review_written))
+
+        # Same additions in the same order as calculate_reward, so equal bit for bit
+        capped_length = np.minimum(review_length, 500) / 500
+        review_challenge = review_written & (challenges >= 0)
+        review_challenge[review_challenge] = self.catalog.is_review[
+            challenges[review_challenge]
+        ]
+
+        rewards = np.where(completed, 1.0, 0.0)
+        rewards += np.where(purchase_made, 2.0, 0.0)
+        rewards += np.where(review_written, 1.5 + capped_length * 1.0, 0.0)
+        rewards += np.where(review_challenge, 1.0, 0.0)
+        rewards += np.where(review_challenge, capped_length * 1.5, 0.0)
+        return rewards
+
+    def update_q_values(self, user, challenge, reward, completed=False):
         """
         Update Q-values based on the observed reward.
 
         Args:
             user: User data
-            challenge: The challenge being evaluated
+            challenge: Name or id of the challenge being evaluated
             reward: Reward received
             completed: Whether the challenge was completed
         """
@@ -238,37 +909,123 @@ class ChallengeRecommendationSystem:
 
         user_id = user["user_id"]
         user_segment = self.get_user_segment(user)
+        challenge_idx = self.catalog.id_of(challenge)
+        segment_idx = SEGMENT_INDEX[user_segment]
 
-        alpha = 0.1
+        alpha = self.learning_rate
         gamma = 0.8
 
-        if user_id in self.user_challenge_q_values:
-            current_q = self.user_challenge_q_values[user_id][challenge]
-            self.user_challenge_q_values[user_id][challenge] = (
-                1 - alpha
-            ) * current_q + alpha * reward
+        # Users get a Q-row on their first update; reads treat unseen users as zeros
+        user_row = self.user_q.ensure(user_id)
+
+        # Logged before any Q-value changes, so a failed log write changes nothing
+        if self.update_log is not None:
+            self.update_log.record(
+                [user_id],
+                [user_segment],
+                [self.challenge_names[challenge_idx]],
+                [reward],
+            )
+
+        self.user_q.update([user_row], [challenge_idx], [reward], alpha)
+
+        self.segments_seen[segment_idx] = True
+        self.pull_counts[segment_idx, challenge_idx] += 1
+        self.reward_sums[segment_idx, challenge_idx] += reward
+        self.segment_q[segment_idx, challenge_idx] = (1 - alpha) * self.segment_q[
+            segment_idx, challenge_idx
+        ] + alpha * reward
 
-        current_segment_q = self.segment_preferences[user_segment][challenge]
-        self.segment_preferences[user_segment][challenge] = (
-            1 - alpha
-        ) * current_segment_q + alpha * reward
+        self.global_q[challenge_idx] = (1 - alpha) * self.global_q[
+            challenge_idx
+        ] + alpha * reward
 
-        current_global_q = self.challenge_q_values[challenge]
-        self.challenge_q_values[challenge] = (
-            1 - alpha
-        ) * current_global_q + alpha * reward
+        self.q_versions[0] += 1
+        self.q_versions[1 + segment_idx] += 1
+
+    def update_q_values_batch(self, users, challenges, rewards):
+        """
+        Apply many Q-value updates at once, equivalent to calling
+        update_q_values for each event in order.
+
+        Every step that can fail (resolving users, segments and challenges,
+        allocating user rows and writing the update log) runs before any
+        Q-value changes, so a batch that raises can be applied again without
+        counting any of its events twice.
+
+        Args:
+            users: DataFrame or list of user dicts, one per event
+            challenges: Challenge name or id per event
+            rewards: Reward per event
+        """
+        user_ids, lifetime_purchases, reviews_written = user_columns(users)
+        segments = segment_codes(lifetime_purchases, reviews_written)
+        challenge_idx = self.catalog.ids_of(challenges)
+        rewards = np.asarray(rewards, dtype=float)
+        user_rows = self.user_q.ensure_many(user_ids)
+
+        if self.update_log is not None:
+            self.update_log.record(
+                user_ids,
+                [SEGMENTS[s] for s in segments],
+                [self.challenge_names[c] for c in challenge_idx],
+                rewards,
+            )
+
+        self.apply_q_updates(user_rows, segments, challenge_idx, rewards)
+
+    def apply_q_updates(self, user_rows, segments, challenge_idx, rewards):
+        """
+        Apply Q-value update events given as index arrays, in order.
+
+        Args:
+            user_rows: Row index into user_q per event, -1 skips the user table
+            segments: Index into SEGMENTS per event
+            challenge_idx: Challenge index per event
+            rewards: Reward per event
+        """
+        rewards = np.asarray(rewards, dtype=float)
+        num_challenges = len(self.challenge_names)
+
+        alpha = self.learning_rate
+
+        self.user_q.update(user_rows, challenge_idx, rewards, alpha)
+
+        segment_keys = segments * num_challenges + challenge_idx
+        num_keys = self.pull_counts.size
+
+        self.segments_seen[np.unique(segments)] = True
+        self.pull_counts += np.bincount(segment_keys, minlength=num_keys).reshape(
+            self.pull_counts.shape
+        )
+        self.reward_sums += np.bincount(
+            segment_keys, weights=rewards, minlength=num_keys
+        ).reshape(self.reward_sums.shape)
+        apply_ema_updates(self.segment_q.reshape(-1), segment_keys, rewards, alpha)
+
+        apply_ema_updates(self.global_q, challenge_idx, rewards, alpha)
+
+        self.q_versions[0] += 1
+        self.q_versions[1 + np.unique(segments)] += 1
+
+    def record_interactions(self, challenge_idx, completed):
+        """Count attempts and completions for many simulated interactions"""
+        num_challenges = len(self.catalog)
+        self.attempt_counts += np.bincount(challenge_idx, minlength=num_challenges)
+        self.completion_counts += np.bincount(
+            challenge_idx[completed], minlength=num_challenges
+        )
 
     def get_challenge_insights(self):
         """Get insights about challenge performance"""
-        completion_rates = {}
-        for challenge in self.challenges:
-            attempts = max(1, self.challenge_attempts[challenge])
-            completions = self.challenge_completions[challenge]
-            completion_rates[challenge] = completions / attempts
+        completion_rates = dict(
+            zip(
+                self.challenge_names,
+                (self.completion_counts / np.maximum(1, self.attempt_counts)).tolist(),
+            )
+        )
 
-        segment_performance = {}
-        for segment in self.segment_preferences:
-            segment_performance[segment] = dict(self.segment_preferences[segment])
+        segment_performance = self.segment_preferences
 
         return {
             "completion_rates": completion_rates,
@@ -287,32 +1044,49 @@ class ChallengeRecommendationSystem:
             list: Top recommended challenges
         """
         user_id = user["user_id"]
-        user_segment = self.get_user_segment(user)
+        segment_idx = SEGMENT_INDEX[self.get_user_segment(user)]
 
-        if user_id not in self.user_challenge_q_values:
-            self.user_challenge_q_values[user_id] = {
-                challenge: 0.0 for challenge in self.challenges
-            }
-
-        combined_scores = {}
-        for challenge in self.challenges:
-            user_specific_weight = 0.6
-            segment_weight = 0.3
-            global_weight = 0.1
+        user_row = self.user_q.values_of([user_id])[0]
+        self.segments_seen[segment_idx] = True
 
-            combined_score = (
-                user_specific_weight * self.user_challenge_q_values[user_id][challenge]
-                + segment_weight * self.segment_preferences[user_segment][challenge]
-                + global_weight * self.challenge_q_values[challenge]
+        if not user_row.any():
+            ranking = self.segment_ranking(segment_idx)
+        else:
+            ranking = top_k_indices(
+                USER_WEIGHT * user_row
+                + SEGMENT_WEIGHT * self.segment_q[segment_idx]
+                + GLOBAL_WEIGHT * self.global_q,
+                num_recommendations,
             )
 
-            combined_scores[challenge] = combined_score
+        return [self.challenge_names[i] for i in ranking[:num_recommendations]]
+
+    def _cached_ranking(self, key, version, score_fn):
+        cached = self._ranking_cache.get(key)
+        if cached is None or cached[0] != version:
+            # Stable sort keeps catalog order between equally scored challenges
+            cached = (version, np.argsort(-score_fn(), kind="stable"))
+            self._ranking_cache[key] = cached
+        return cached[1]
 
-        sorted_challenges = sorted(
-            combined_scores.items(), key=lambda x: x[1], reverse=True
+    def segment_ranking(self, segment_idx):
+        """
+        Challenge indices ranked for a user without user-specific Q-values.
+
+        Cached per segment until that segment's or the global Q-values change.
+        """
+        return self._cached_ranking(
+            ("segment", segment_idx),
+            (int(self.q_versions[0]), int(self.q_versions[1 + segment_idx])),
+            lambda: SEGMENT_WEIGHT * self.segment_q[segment_idx]
+            + GLOBAL_WEIGHT * self.global_q,
         )
 
-        return [challenge for challenge, _ in sorted_challenges[:num_recommendations]]
+    def global_ranking(self):
+        """Challenge indices ranked by global Q-value, cached until they change"""
+        return self._cached_ranking(
+            ("global",), int(self.q_versions[0]), lambda: self.global_q
+        )
 
 
 def create_test_users(num_users=10):
@@ -331,6 +1105,110 @@ def create_test_users(num_users=10):
     return users
 
 
+class UserState:
+    """
+    Struct-of-arrays user table for large simulations.
+
+    Users are identified by position, challenges by integer id (-1 for none),
+    and columns use the smallest dtype that fits, about 27 bytes per user.
+    Activity counters are int32 so they cannot wrap within any realistic
+    simulation horizon.
+    Columns are read with users["column"] like the DataFrame user tables.
+    The segment column caches segment codes and is only recomputed for users
+    whose counters change through record_activity.
+    """
+
+    __slots__ = (
+        "lifetime_purchases",
+        "reviews_written",
+        "initial_lifetime_purchases",
+        "initial_reviews_written",
+        "completed_challenges",
+        "active_challenge",
+        "challenge_progress",
+        "engagement_probability",
+        "segment",
+    )
+
+    def __init__(self, num_users):
+        self.lifetime_purchases = np.zeros(num_users, dtype=np.int32)
+        self.reviews_written = np.zeros(num_users, dtype=np.int32)
+        self.initial_lifetime_purchases = np.zeros(num_users, dtype=np.int32)
+        self.initial_reviews_written = np.zeros(num_users, dtype=np.int32)
+        self.completed_challenges = np.zeros(num_users, dtype=np.int32)
+        self.active_challenge = np.full(num_users, -1, dtype=np.int8)
+        self.challenge_progress = np.zeros(num_users, dtype=np.int8)
+        self.engagement_probability = np.zeros(num_users, dtype=np.float32)
+        self.segment = np.full(num_users, SEGMENT_INDEX["new"], dtype=np.int8)
+
+    @classmethod
+    def random(cls, num_users, rng, inactive_fraction=0.2):
+        """Sample a population like create_test_users plus engagement levels"""
+        users = cls(num_users)
+        users.lifetime_purchases[:] = rng.integers(0, 5, num_users)
+        users.reviews_written[:] = rng.integers(0, 3, num_users)
+        users.initial_lifetime_purchases[:] = users.lifetime_purchases
+        users.initial_reviews_written[:] = users.reviews_written
+        users.segment[:] = segment_codes(
+            users.lifetime_purchases, users.reviews_written
+        )
+
+        users.engagement_probability[:] = rng.uniform(0.1, 0.9, num_users)
+        inactive_user_indices = rng.choice(
+            num_users, size=int(num_users * inactive_fraction), replace=False
+        )
+        users.engagement_probability[inactive_user_indices] = 0.05
+        return users
+
+    @property
+    def columns(self):
+        return list(self.__slots__)
+
+    def __len__(self):
+        return len(self.lifetime_purchases)
+
+    def __getitem__(self, column):
+        return getattr(self, column)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.__slots__)
+
+    def record_activity(self, purchase, review, completed):
+        """
+        Add one step's purchase, review and completion flags to the counters,
+        re-segmenting only the users whose purchase or review counts changed.
+        """
+        self.lifetime_purchases += purchase
+        self.reviews_written += review
+        self.completed_challenges += completed
+
+        changed = np.flatnonzero(purchase | review)
+        self.segment[changed] = segment_codes(
+            self.lifetime_purchases[changed], self.reviews_written[changed]
+        )
+
+    def needs_challenge(self, max_progress):
+        """Mask of users with no active challenge or a finished one"""
+        return (self.active_challenge < 0) | (
+            self.challenge_progress >= max_progress[self.active_challenge]
+        )
+
+    def to_frame(self, user_ids, challenge_names):
+        """Expand to the DataFrame user table layout"""
+        # Index -1 (no active challenge) picks the trailing None
+        active_names = np.array(list(challenge_names) + [None], dtype=object)
+        columns = [column for column in self.__slots__ if column != "segment"]
+        return pd.DataFrame(
+            {
+                "user_id": user_ids,
+                **{column: getattr(self, column) for column in columns},
+                "active_challenge": active_names[self.active_challenge],
+            },
+            columns=["user_id"] + columns,
+        )
+
+
 def run_challenge_simulation_with_inactive_users(num_iterations=30):
     """
     Run a simulation that includes users who don't complete challenges.
@@ -339,6 +1217,8 @@ def run_challenge_simulation_with_inactive_users(num_iterations=30):
     """
     recommendation_system = ChallengeRecommendationSystem(exploration_rate=0.2)
     users = create_test_users(15)
+    users["initial_lifetime_purchases"] = users["lifetime_purchases"]
+    users["initial_reviews_written"] = users["reviews_written"]
 
     users["engagement_probability"] = np.random.uniform(0.1, 0.9, len(users))
 
@@ -356,6 +1236,9 @@ def run_challenge_simulation_with_inactive_users(num_iterations=30):
         print(f"\n--- Iteration {iteration + 1} ---")
 
         for idx, user in users.iterrows():
+            # The row is a snapshot, so its segment is fixed for this iteration
+            user_segment = recommendation_system.get_user_segment(user)
+
             if user["active_challenge"] is None or (
                 user["active_challenge"] is not None
                 and user["challenge_progress"]
@@ -367,7 +1250,7 @@ def run_challenge_simulation_with_inactive_users(num_iterations=30):
                 users.at[idx, "active_challenge"] = selected_challenge
                 users.at[idx, "challenge_progress"] = 0
                 print(
-                    f"User {user['user_id']} ({recommendation_system.get_user_segment(user)}) assigned: '{selected_challenge}'"
+                    f"User {user['user_id']} ({user_segment}) assigned: '{selected_challenge}'"
                 )
 
             if np.random.random() > user["engagement_probability"]:
@@ -383,7 +1266,7 @@ def run_challenge_simulation_with_inactive_users(num_iterations=30):
                         {
                             "iteration": iteration + 1,
                             "user_id": user["user_id"],
-                            "segment": recommendation_system.get_user_segment(user),
+                            "segment": user_segment,
                             "challenge": user["active_challenge"],
                             "completed": False,
                             "purchase_made": False,
@@ -409,10 +1292,9 @@ def run_challenge_simulation_with_inactive_users(num_iterations=30):
 
             review_length = 0
             if review:
-                is_review_challenge = (
-                    user["active_challenge"] is not None
-                    and "review" in user["active_challenge"].lower()
-                )
+                is_review_challenge = recommendation_system.catalog.is_review[
+                    recommendation_system.catalog.id_of(user["active_challenge"])
+                ]
                 base_length = 200 if is_review_challenge else 100
                 engagement_factor = user["engagement_probability"] * 300
 
@@ -470,7 +1352,7 @@ def run_challenge_simulation_with_inactive_users(num_iterations=30):
                 {
                     "iteration": iteration + 1,
                     "user_id": user["user_id"],
-                    "segment": recommendation_system.get_user_segment(user),
+                    "segment": user_segment,
                     "challenge": user["active_challenge"],
                     "completed": completed,
                     "purchase_made": purchase,
@@ -502,130 +1384,292 @@ def run_challenge_simulation_with_inactive_users(num_iterations=30):
     return recommendation_system, users, results_df
 
 
-def analyze_results_with_inactivity(recommendation_system, users, results):
-    print("\n=== SIMULATION RESULTS WITH INACTIVITY ANALYSIS ===")
+# Interaction probabilities per segment, in SEGMENTS order
+SEGMENT_PURCHASE_PROB = np.array([0.3, 0.2, 0.1, 0.1])
+SEGMENT_REVIEW_PROB = np.array([0.2, 0.15, 0.25, 0.1])
 
-    print("\nUser Growth:")
-    initial_users = create_test_users(len(users))
-    print(
-        f"Initial average purchases: {initial_users['lifetime_purchases'].mean():.2f}"
+
+def run_challenge_simulation_vectorized(
+    num_iterations=30,
+    num_users=15,
+    exploration_rate=0.2,
+    learning_rate=0.1,
+    seed=None,
+    verbose=False,
+    results_path=None,
+    compact_users=False,
+    policy="epsilon_greedy",
+):
+    """
+    Run the inactive-user simulation with every iteration computed for all
+    users at once on NumPy arrays.
+
+    Follows run_challenge_simulation_with_inactive_users, except that a newly
+    assigned challenge is played in the same iteration it is assigned.
+
+    Args:
+        num_iterations: Number of simulation steps
+        num_users: Size of the simulated user population
+        exploration_rate: Exploration rate of the recommendation system
+        learning_rate: Learning rate of the recommendation system
+        seed: Seed or np.random.SeedSequence for the simulation's Generator
+        verbose: Print a summary line per iteration
+        results_path: Directory to stream results to in chunks instead of
+            building them in memory
+        compact_users: Return the final users as a UserState instead of a
+            DataFrame
+        policy: Challenge selection policy of the recommendation system
+
+    Returns:
+        tuple: (recommendation_system, users, results), where results is a
+        DataFrame, or results_path when streaming
+    """
+    rng = np.random.default_rng(seed)
+    recommendation_system = ChallengeRecommendationSystem(
+        exploration_rate=exploration_rate, learning_rate=learning_rate, policy=policy
     )
-    print(f"Final average purchases: {users['lifetime_purchases'].mean():.2f}")
-    print(
+
+    catalog = recommendation_system.catalog
+    challenge_names = catalog.names
+    max_progress = catalog.max_progress
+
+    user_ids = [f"user_{i}" for i in range(num_users)]
+    user_rows = recommendation_system.user_q.ensure_many(user_ids)
+    users = UserState.random(num_users, rng)
+
+    if results_path is not None:
+        results_writer = ResultsWriter(
+            results_path, user_ids, SEGMENTS, recommendation_system.challenge_names
+        )
+    else:
+        columns = {name: [] for name in RESULT_COLUMNS}
+
+    for iteration in range(num_iterations):
+        segments = users.segment.astype(np.intp)
+
+        needs_challenge = users.needs_challenge(max_progress)
+        if needs_challenge.any():
+            users.active_challenge[needs_challenge] = (
+                recommendation_system.select_challenge_indices(
+                    user_rows[needs_challenge], segments[needs_challenge], rng
+                )
+            )
+            users.challenge_progress[needs_challenge] = 0
+
+        challenge = users.active_challenge.astype(np.intp)
+        engaged = rng.random(num_users) <= users.engagement_probability
+
+        # Engaged users advance one step (every challenge has max_progress >= 1)
+        completed = engaged & (users.challenge_progress + 1 >= max_progress[challenge])
+        users.challenge_progress += engaged
+
+        purchase_prob = SEGMENT_PURCHASE_PROB[segments] * np.where(
+            catalog.is_purchase[challenge], 2, 1
+        )
+        review_prob = SEGMENT_REVIEW_PROB[segments] * np.where(
+            catalog.is_review[challenge] & ~catalog.is_purchase[challenge], 2, 1
+        )
+        purchase = engaged & (rng.random(num_users) < purchase_prob)
+        review = engaged & (rng.random(num_users) < review_prob)
+
+        review_length = np.maximum(
+            20,
+            (
+                np.where(catalog.is_review[challenge], 200, 100)
+                + users.engagement_probability * 300
+                + rng.uniform(-50, 150, num_users)
+            ).astype(np.int64),
+        )
+        review_length = np.where(review, review_length, 0)
+
+        reward = recommendation_system.calculate_rewards(
+            challenge, completed, purchase, review, review_length
+        )
+
+        recommendation_system.record_interactions(
+            challenge[engaged], completed[engaged]
+        )
+        recommendation_system.apply_q_updates(user_rows, segments, challenge, reward)
+
+        users.record_activity(purchase, review, completed)
+        users.active_challenge[completed] = -1
+
+        batch = {
+            "iteration": np.full(num_users, iteration + 1),
+            "user": np.arange(num_users),
+            "segment": segments,
+            "challenge": challenge,
+            "completed": completed,
+            "purchase_made": purchase,
+            "review_written": review,
+            "review_length": review_length,
+            "reward": reward,
+            "engaged": engaged,
+        }
+        if results_path is not None:
+            results_writer.append(**batch)
+        else:
+            for name, values in batch.items():
+                columns[name].append(values)
+
+        if verbose:
+            print(
+                f"--- Iteration {iteration + 1} --- engaged: {engaged.sum()}/{num_users}, "
+                f"completed: {completed.sum()}, purchases: {purchase.sum()}, "
+                f"reviews: {review.sum()}"
+            )
+
+    if results_path is not None:
+        results_writer.close()
+        results = results_path
+    else:
+        results_columns = {
+            name: np.concatenate(values) for name, values in columns.items()
+        }
+        user_index = results_columns.pop("user")
+        results = pd.DataFrame(
+            {
+                "iteration": results_columns.pop("iteration"),
+                "user_id": np.array(user_ids, dtype=object)[user_index],
+                "segment": pd.Categorical.from_codes(
+                    results_columns.pop("segment"), SEGMENTS
+                ),
+                "challenge": pd.Categorical.from_codes(
+                    results_columns.pop("challenge"), challenge_names
+                ),
+                **results_columns,
+            }
+        )
+
+    if not compact_users:
+        users = users.to_frame(user_ids, challenge_names)
+
+    return recommendation_system, users, results
+
+
+def _by_value(rates):
+    return sorted(rates.items(), key=lambda x: x[1], reverse=True)
+
+
+def analyze_results_with_inactivity(
+    recommendation_system, users, results, verbose=True
+):
+    """
+    Report and summarize a simulation run.
+
+    Args:
+        recommendation_system: The trained ChallengeRecommendationSystem
+        users: Final user table, with initial_lifetime_purchases and
+            initial_reviews_written as the growth baseline when present
+        results: Results DataFrame, or a results directory written by
+            ResultsWriter, which is aggregated chunk by chunk
+        verbose: Print the report
+
+    Returns:
+        dict: Summary metrics, empty if no results were recorded
+    """
+    log = print if verbose else lambda *args, **kwargs: None
+
+    log("\n=== SIMULATION RESULTS WITH INACTIVITY ANALYSIS ===")
+
+    log("\nUser Growth:")
+    if "initial_lifetime_purchases" in users.columns:
+        initial_users = pd.DataFrame(
+            {
+                "lifetime_purchases": users["initial_lifetime_purchases"],
+                "reviews_written": users["initial_reviews_written"],
+            }
+        )
+    else:
+        # No recorded starting state: fall back to a freshly sampled population
+        initial_users = create_test_users(len(users))
+    log(f"Initial average purchases: {initial_users['lifetime_purchases'].mean():.2f}")
+    log(f"Final average purchases: {users['lifetime_purchases'].mean():.2f}")
+    log(
         f"Purchase growth: {(users['lifetime_purchases'].mean() - initial_users['lifetime_purchases'].mean()):.2f}"
     )
 
-    print(f"Initial average reviews: {initial_users['reviews_written'].mean():.2f}")
-    print(f"Final average reviews: {users['reviews_written'].mean():.2f}")
-    print(
+    log(f"Initial average reviews: {initial_users['reviews_written'].mean():.2f}")
+    log(f"Final average reviews: {users['reviews_written'].mean():.2f}")
+    log(
         f"Review growth: {(users['reviews_written'].mean() - initial_users['reviews_written'].mean()):.2f}"
     )
 
-    print("\nChallenge Completion Rates:")
+    log("\nChallenge Completion Rates:")
     completion_rates = recommendation_system.get_challenge_insights()[
         "completion_rates"
     ]
-    for challenge, rate in sorted(
-        completion_rates.items(), key=lambda x: x[1], reverse=True
-    ):
-        print(f"  {challenge}: {rate*100:.1f}%")
+    for challenge, rate in _by_value(completion_rates):
+        log(f"  {challenge}: {rate*100:.1f}%")
+
+    if is_results_directory(results):
+        aggregator = aggregate_results_directory(results)
+    else:
+        aggregator = aggregate_results_frame(results)
 
-    if results.empty:
-        print("\nNo results recorded in simulation.")
+    if not aggregator.rows:
+        log("\nNo results recorded in simulation.")
         return {}
 
-    if "engaged" in results.columns:
-        engagement_rate = results["engaged"].mean() * 100
-        print(f"\nOverall Engagement Rate: {engagement_rate:.1f}%")
-
-        segment_engagement = results.groupby("segment")["engaged"].mean() * 100
-        print("\nEngagement Rate by Segment:")
-        for segment, rate in segment_engagement.sort_values(ascending=False).items():
-            print(f"  {segment}: {rate:.1f}%")
-
-        challenge_engagement = results.groupby("challenge")["engaged"].mean() * 100
-        print("\nEngagement Rate by Challenge:")
-        for challenge, rate in challenge_engagement.sort_values(
-            ascending=False
-        ).items():
-            if challenge is not None:
-                print(f"  {challenge}: {rate:.1f}%")
-
-        inactive_users = users[users["completed_challenges"] == 0]
-        print(
-            f"\nUsers who never completed a challenge: {len(inactive_users)} ({len(inactive_users)/len(users)*100:.1f}%)"
-        )
+    grouped = aggregator.metrics()
 
-        if not results[results["engaged"]].empty:
-            challenge_abandonment = (
-                1 - results[results["engaged"]].groupby("challenge")["completed"].mean()
-            )
-            print("\nChallenges with Highest Abandonment Rate:")
-            for challenge, rate in (
-                challenge_abandonment.sort_values(ascending=False).head(3).items()
-            ):
-                if challenge is not None:
-                    print(f"  {challenge}: {rate*100:.1f}% abandonment")
-
-    print("\nPurchase Rate by Challenge:")
-    if "purchase_made" in results.columns and results["purchase_made"].any():
-        challenge_purchase_rates = results.groupby("challenge")["purchase_made"].mean()
-        for challenge, rate in challenge_purchase_rates.sort_values(
-            ascending=False
-        ).items():
-            if challenge is not None:
-                print(f"  {challenge}: {rate*100:.1f}%")
+    log(f"\nOverall Engagement Rate: {grouped['overall_engagement']:.1f}%")
+
+    log("\nEngagement Rate by Segment:")
+    for segment, rate in _by_value(grouped["segment_engagement"]):
+        log(f"  {segment}: {rate:.1f}%")
+
+    log("\nEngagement Rate by Challenge:")
+    for challenge, rate in _by_value(grouped["challenge_engagement"]):
+        log(f"  {challenge}: {rate:.1f}%")
+
+    num_inactive_users = int((users["completed_challenges"] == 0).sum())
+    log(
+        f"\nUsers who never completed a challenge: {num_inactive_users} ({num_inactive_users/len(users)*100:.1f}%)"
+    )
+
+    if grouped["challenge_abandonment"]:
+        log("\nChallenges with Highest Abandonment Rate:")
+        for challenge, rate in _by_value(grouped["challenge_abandonment"])[:3]:
+            log(f"  {challenge}: {rate*100:.1f}% abandonment")
+
+    log("\nPurchase Rate by Challenge:")
+    if grouped["purchase_rates"]:
+        for challenge, rate in _by_value(grouped["purchase_rates"]):
+            log(f"  {challenge}: {rate*100:.1f}%")
     else:
-        print("  No purchase data available")
-
-    if "review_length" in results.columns and "review_written" in results.columns:
-        reviews = results[results["review_written"] == True]
-        if not reviews.empty:
-            avg_review_length = reviews["review_length"].mean()
-            print(f"\nAverage Review Length: {avg_review_length:.1f} characters")
-
-            challenge_review_lengths = reviews.groupby("challenge")[
-                "review_length"
-            ].mean()
-            print("\nAverage Review Length by Challenge:")
-            for challenge, length in challenge_review_lengths.sort_values(
-                ascending=False
-            ).items():
-                if challenge is not None:
-                    print(f"  {challenge}: {length:.1f} characters")
-
-            segment_review_lengths = reviews.groupby("segment")["review_length"].mean()
-            print("\nAverage Review Length by User Segment:")
-            for segment, length in segment_review_lengths.sort_values(
-                ascending=False
-            ).items():
-                print(f"  {segment}: {length:.1f} characters")
-
-            if len(reviews) > 1:
-                review_length_reward_corr = reviews["review_length"].corr(
-                    reviews["reward"]
-                )
-                print(
-                    f"\nCorrelation between Review Length and Reward: {review_length_reward_corr:.2f}"
-                )
+        log("  No purchase data available")
+
+    if "avg_review_length" in grouped:
+        log(f"\nAverage Review Length: {grouped['avg_review_length']:.1f} characters")
+
+        log("\nAverage Review Length by Challenge:")
+        for challenge, length in _by_value(grouped["challenge_review_lengths"]):
+            log(f"  {challenge}: {length:.1f} characters")
 
-    print("\nBest Challenges by User Segment:")
+        log("\nAverage Review Length by User Segment:")
+        for segment, length in _by_value(grouped["segment_review_lengths"]):
+            log(f"  {segment}: {length:.1f} characters")
+
+        if "review_length_reward_correlation" in grouped:
+            log(
+                f"\nCorrelation between Review Length and Reward: {grouped['review_length_reward_correlation']:.2f}"
+            )
+
+    log("\nBest Challenges by User Segment:")
     segment_performance = recommendation_system.get_challenge_insights()[
         "segment_performance"
     ]
     for segment, challenges in segment_performance.items():
         if challenges:
             best_challenge = max(challenges.items(), key=lambda x: x[1])
-            print(f"  {segment}: {best_challenge[0]} (avg reward: {best_challenge[1]})")
+            log(f"  {segment}: {best_challenge[0]} (avg reward: {best_challenge[1]})")
 
-    print("\nFinal Challenge Q-Values:")
-    for challenge, q_value in sorted(
-        recommendation_system.challenge_q_values.items(),
-        key=lambda x: x[1],
-        reverse=True,
-    ):
-        print(f"  {challenge}: {q_value:.2f}")
+    log("\nFinal Challenge Q-Values:")
+    for challenge, q_value in _by_value(recommendation_system.challenge_q_values):
+        log(f"  {challenge}: {q_value:.2f}")
 
+    grouped.pop("challenge_abandonment")
     metrics = {
         "purchase_growth": users["lifetime_purchases"].mean()
         - initial_users["lifetime_purchases"].mean(),
@@ -636,30 +1680,9 @@ def analyze_results_with_inactivity(recommendation_system, users, results):
             for s, c in segment_performance.items()
         },
         "completion_rates": completion_rates,
+        **grouped,
     }
 
-    if "engaged" in results.columns:
-        metrics["overall_engagement"] = engagement_rate
-        metrics["segment_engagement"] = segment_engagement.to_dict()
-        metrics["challenge_engagement"] = challenge_engagement.to_dict()
-
-    if "purchase_made" in results.columns and not results.empty:
-        metrics["purchase_rates"] = (
-            challenge_purchase_rates.to_dict()
-            if not challenge_purchase_rates.empty
-            else {}
-        )
-
-    if "review_length" in results.columns and "review_written" in results.columns:
-        reviews = results[results["review_written"] == True]
-        if not reviews.empty:
-            avg_review_length = reviews["review_length"].mean()
-            metrics["avg_review_length"] = avg_review_length
-            metrics["challenge_review_lengths"] = challenge_review_lengths.to_dict()
-            metrics["segment_review_lengths"] = segment_review_lengths.to_dict()
-            if len(reviews) > 1:
-                metrics["review_length_reward_correlation"] = review_length_reward_corr
-
     return metrics
 
 
@@ -1,112 +1,123 @@
+import functools
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
 import numpy as np
-import pandas as pd
-from flask import Flask, jsonify, request
+from flask import Flask, Request, Response, g, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+
+import loyalty
+from loyalty_metrics import MetricsRegistry
+from loyalty_snapshot import load_snapshot
+from loyalty_store import BoundedUserQTable, QTableStore
+
+# Directory of a shared, memory-mapped Q-table store; unset keeps Q-values in memory
+LOYALTY_STORE_PATH = os.environ.get("LOYALTY_STORE_PATH")
+
+# In-memory mode only: most users kept in memory (0 for no limit), seconds of
+# inactivity before a user is evicted, and a file prefix to spill evicted users to
+LOYALTY_MAX_USERS = int(os.environ.get("LOYALTY_MAX_USERS", "0"))
+LOYALTY_USER_TTL = float(os.environ.get("LOYALTY_USER_TTL", "0")) or None
+LOYALTY_SPILL_PATH = os.environ.get("LOYALTY_SPILL_PATH")
+# In-memory mode only: store user Q-values sparsely (touched challenges only)
+LOYALTY_SPARSE_USER_Q = os.environ.get("LOYALTY_SPARSE_USER_Q") == "1"
+# Snapshot to warm-start from: seeds a new, empty store, or in in-memory mode
+# restores the snapshot's own user table and excludes the options above
+LOYALTY_SNAPSHOT_PATH = os.environ.get("LOYALTY_SNAPSHOT_PATH")
+# Challenge selection policy, one of loyalty.POLICIES
+LOYALTY_POLICY = os.environ.get("LOYALTY_POLICY", "epsilon_greedy")
+# Directory where worker processes keep metrics for /metrics to aggregate;
+# unset keeps them in this process
+LOYALTY_METRICS_DIR = os.environ.get("LOYALTY_METRICS_DIR")
+
+metrics_registry = MetricsRegistry(LOYALTY_METRICS_DIR)
+REQUEST_SECONDS = metrics_registry.histogram(
+    "loyalty_request_seconds",
+    "Request latency inside Flask, from routing to the finished response",
+    ["endpoint"],
+)
+STAGE_SECONDS = metrics_registry.histogram(
+    "loyalty_request_stage_seconds",
+    "Request time spent parsing JSON, in the handler itself and serializing JSON",
+    ["endpoint", "stage"],
+)
+REQUESTS = metrics_registry.counter(
+    "loyalty_requests_total", "Requests served", ["endpoint", "status"]
+)
+Q_UPDATE_BATCH_SECONDS = metrics_registry.histogram(
+    "loyalty_q_update_batch_seconds", "Time the writer spent applying one batch"
+)
+Q_UPDATES = metrics_registry.counter(
+    "loyalty_q_updates_total", "Q-value update events handled by the writer", ["result"]
+)
+Q_UPDATE_QUEUE_DEPTH = metrics_registry.gauge(
+    "loyalty_q_update_queue_depth", "Q-value update requests waiting for the writer"
+)
+
+
+def _record_json_stage(stage, seconds):
+    if "json_seconds" in g:
+        g.json_seconds += seconds
+    STAGE_SECONDS.observe(seconds, request.endpoint or "unmatched", stage)
+
+
+class TimedRequest(Request):
+    def get_json(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().get_json(*args, **kwargs)
+        finally:
+            _record_json_stage("parse_json", time.perf_counter() - start)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            _record_json_stage("serialize_json", time.perf_counter() - start)
+
 
 app = Flask(__name__)
+app.request_class = TimedRequest
+app.json = TimedJSONProvider(app)
 
 
-class ChallengeRecommendationSystem:
-    def __init__(self, exploration_rate=0.2):
-        self.exploration_rate = exploration_rate
-        self.challenges = {
-            "First Purchase": {
-                "description": "Make your first purchase",
-                "max_progress": 1,
-            },
-            "Write a Review": {
-                "description": "Write a review for a product",
-                "max_progress": 1,
-            },
-            "Complete Your Profile": {
-                "description": "Fill out all profile information",
-                "max_progress": 5,
-            },
-            "Browse Five Products": {
-                "description": "View details of five different products",
-                "max_progress": 5,
-            },
-            "Add to Wishlist": {
-                "description": "Add three products to your wishlist",
-                "max_progress": 3,
-            },
-            "Share on Social Media": {
-                "description": "Share a product on social media",
-                "max_progress": 1,
-            },
-            "Refer a Friend": {
-                "description": "Refer a friend to our platform",
-                "max_progress": 1,
-            },
-            "Complete a Survey": {
-                "description": "Fill out our customer satisfaction survey",
-                "max_progress": 1,
-            },
-            "Download Our App": {
-                "description": "Download and log in to our mobile app",
-                "max_progress": 2,
-            },
-            "Make a Repeat Purchase": {
-                "description": "Make another purchase within 30 days",
-                "max_progress": 1,
-            },
-            "Write an In-depth Review": {
-                "description": "Write a detailed review with pros and cons",
-                "max_progress": 1,
-            },
-            "Watch Product Video": {
-                "description": "Watch our product demonstration videos",
-                "max_progress": 3,
-            },
-        }
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-        self.user_challenge_q_values = {}
-        self.segment_preferences = {
-            "high_value": {c: 0.5 for c in self.challenges},
-            "purchaser": {c: 0.3 for c in self.challenges},
-            "engaged": {c: 0.2 for c in self.challenges},
-            "new": {c: 0.1 for c in self.challenges},
-        }
-        self.challenge_q_values = {c: 0.2 for c in self.challenges}
-        self.challenge_attempts = {c: 0 for c in self.challenges}
-        self.challenge_completions = {c: 0 for c in self.challenges}
-
-    def get_user_segment(self, user):
-        """Determine user segment based on user data"""
-        if user["lifetime_purchases"] > 3:
-            return "high_value"
-        elif user["lifetime_purchases"] > 0:
-            return "purchaser"
-        elif user["reviews_written"] > 0:
-            return "engaged"
-        return "new"
-
-    def select_challenge(self, user):
-        """Select a challenge for the user"""
-        user_id = user["user_id"]
-        user_segment = self.get_user_segment(user)
-
-        if user_id not in self.user_challenge_q_values:
-            self.user_challenge_q_values[user_id] = {c: 0.0 for c in self.challenges}
-
-        if np.random.random() < self.exploration_rate:
-            return np.random.choice(list(self.challenges.keys()))
-
-        combined_q_values = {
-            c: (
-                0.6 * self.user_challenge_q_values[user_id][c]
-                + 0.3 * self.segment_preferences[user_segment][c]
-                + 0.1 * self.challenge_q_values[c]
-            )
-            for c in self.challenges
-        }
 
-        return max(combined_q_values, key=combined_q_values.get)
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or "unmatched"
+    if "request_start" in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint)
+    REQUESTS.inc(endpoint, str(response.status_code))
+    return response
+
+
+class ChallengeRecommendationSystem(loyalty.ChallengeRecommendationSystem):
+    def __init__(self, exploration_rate=0.2, policy="epsilon_greedy"):
+        super().__init__(exploration_rate, policy=policy)
+
+        # Service priors: segment rows in loyalty.SEGMENTS order
+        self.segment_q[:] = np.array([[0.5], [0.3], [0.2], [0.1]])
+        self.segments_seen[:] = True
+        self.global_q[:] = 0.2
 
     def simulate_user_interaction(self, user, challenge):
-        """Simulate user interaction with a challenge"""
-        if not challenge:
+        """Simulate user interaction with a challenge given by name or id"""
+        if challenge is None or challenge == "":
             return 0, False, False, False
 
+        challenge_id = self.catalog.id_of(challenge)
+        max_progress = int(self.catalog.max_progress[challenge_id])
+
         base_progress = 1
         purchase_prob = 0.1
         review_prob = 0.1
@@ -119,16 +130,13 @@ class ChallengeRecommendationSystem:
         elif segment == "engaged":
             review_prob = 0.25
 
-        if "Purchase" in challenge:
+        if self.catalog.is_purchase[challenge_id]:
             purchase_prob *= 2
-        elif "Review" in challenge:
+        elif self.catalog.is_review[challenge_id]:
             review_prob *= 2
 
-        progress = min(base_progress, self.challenges[challenge]["max_progress"])
-        completed = (
-            user["challenge_progress"] + progress
-            >= self.challenges[challenge]["max_progress"]
-        )
+        progress = min(base_progress, max_progress)
+        completed = user["challenge_progress"] + progress >= max_progress
         purchase_made = np.random.random() < purchase_prob
         review_written = np.random.random() < review_prob
 
@@ -146,36 +154,268 @@ class ChallengeRecommendationSystem:
 
         return reward
 
-    def update_q_values(self, user, challenge, reward):
-        """Update Q-values based on the observed reward"""
-        if challenge is None:
-            return
-
-        user_id = user["user_id"]
-        user_segment = self.get_user_segment(user)
-
-        alpha = 0.1
-        self.user_challenge_q_values[user_id][challenge] = (
-            1 - alpha
-        ) * self.user_challenge_q_values[user_id][challenge] + alpha * reward
-        self.segment_preferences[user_segment][challenge] = (
-            1 - alpha
-        ) * self.segment_preferences[user_segment][challenge] + alpha * reward
-        self.challenge_q_values[challenge] = (1 - alpha) * self.challenge_q_values[
-            challenge
-        ] + alpha * reward
+    def calculate_rewards(
+        self, challenges, completed, purchase_made, review_written, review_length=None
+    ):
+        """
+        Calculate rewards for arrays of interactions, equal to calculate_reward.
+        Takes the parent's arguments; challenges do not affect the service reward.
+        """
+        if review_length is None:
+            review_length = np.zeros(len(review_written))
+
+        rewards = np.where(completed, 1.0, 0.0)
+        rewards += np.where(purchase_made, 2.0, 0.0)
+        rewards += np.where(
+            review_written,
+            1.5 + np.minimum(np.asarray(review_length) / 500 * 1.0, 1.0),
+            0.0,
+        )
+        return rewards
 
     def get_challenge_insights(self):
         """Retrieve challenge performance insights"""
         return {
-            "completion_rates": {
-                c: self.challenge_completions[c] / max(1, self.challenge_attempts[c])
-                for c in self.challenges
-            }
+            "completion_rates": dict(
+                zip(
+                    self.challenge_names,
+                    (
+                        self.completion_counts / np.maximum(1, self.attempt_counts)
+                    ).tolist(),
+                )
+            )
         }
 
 
-recommendation_system = ChallengeRecommendationSystem()
+recommendation_system = ChallengeRecommendationSystem(policy=LOYALTY_POLICY)
+# User table options of in-memory mode that are set
+user_table_options = [
+    name
+    for name, value in (
+        ("LOYALTY_MAX_USERS", LOYALTY_MAX_USERS),
+        ("LOYALTY_USER_TTL", LOYALTY_USER_TTL),
+        ("LOYALTY_SPILL_PATH", LOYALTY_SPILL_PATH),
+        ("LOYALTY_SPARSE_USER_Q", LOYALTY_SPARSE_USER_Q),
+    )
+    if value
+]
+if LOYALTY_STORE_PATH:
+    # The store keeps a dense, shared user table; in-memory layouts cannot back it
+    if user_table_options:
+        raise ValueError(
+            f"{', '.join(user_table_options)} only apply to in-memory mode and "
+            f"cannot be combined with LOYALTY_STORE_PATH={LOYALTY_STORE_PATH}"
+        )
+    q_table_store = QTableStore(
+        LOYALTY_STORE_PATH, recommendation_system, snapshot_path=LOYALTY_SNAPSHOT_PATH
+    )
+else:
+    q_table_store = None
+    # A snapshot brings its own user table, which would silently replace the
+    # configured one and drop its memory cap
+    if LOYALTY_SNAPSHOT_PATH and user_table_options:
+        raise ValueError(
+            f"{', '.join(user_table_options)} cannot be combined with "
+            f"LOYALTY_SNAPSHOT_PATH={LOYALTY_SNAPSHOT_PATH}: the snapshot's user "
+            "table replaces the configured one"
+        )
+    if LOYALTY_SNAPSHOT_PATH:
+        load_snapshot(LOYALTY_SNAPSHOT_PATH, recommendation_system)
+    elif LOYALTY_MAX_USERS:
+        recommendation_system.user_q = BoundedUserQTable(
+            len(recommendation_system.catalog),
+            capacity=LOYALTY_MAX_USERS,
+            ttl=LOYALTY_USER_TTL,
+            # One spill file per worker process
+            spill_path=(
+                f"{LOYALTY_SPILL_PATH}.{os.getpid()}.sqlite"
+                if LOYALTY_SPILL_PATH
+                else None
+            ),
+        )
+    elif LOYALTY_SPARSE_USER_Q:
+        recommendation_system.user_q = loyalty.SparseUserQTable(
+            len(recommendation_system.catalog)
+        )
+
+
+def q_table_lock():
+    """Serialize Q-value writes across worker processes sharing a store"""
+    return q_table_store.lock() if q_table_store is not None else nullcontext()
+
+
+class PendingQUpdates:
+    def __init__(self, users, challenges, rewards):
+        """
+        Q-value update events of one request, queued for the writer.
+
+        Args:
+            users: User dict per event
+            challenges: Challenge name or id per event
+            rewards: Reward per event
+        """
+        self.users = users
+        self.challenges = challenges
+        self.rewards = rewards
+        self.applied = threading.Event()
+        # Set by the writer when these events could not be applied
+        self.error = None
+
+    def __len__(self):
+        return len(self.users)
+
+    def wait(self):
+        """Block until the writer is done with these events; return its error"""
+        self.applied.wait()
+        return self.error
+
+
+class QValueWriter:
+    def __init__(self, recommendation_system, max_batch=10000):
+        """
+        Single writer thread for Q-value updates.
+
+        Request threads only enqueue events; the writer drains the queue and
+        applies everything pending as one batch, so Q-tables have exactly
+        one writer per process and reads never take a lock. If a batch fails,
+        its requests are re-applied one at a time so a bad request only fails
+        itself.
+
+        Args:
+            recommendation_system: System whose Q-tables are updated
+            max_batch: Most events applied per batch
+        """
+        self.recommendation_system = recommendation_system
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="q-value-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, users, challenges, rewards):
+        """
+        Queue update events for the writer.
+
+        Returns:
+            PendingQUpdates: Waitable for the outcome of the events
+        """
+        pending = PendingQUpdates(users, challenges, rewards)
+        Q_UPDATE_QUEUE_DEPTH.inc()
+        self.queue.put(pending)
+        return pending
+
+    def _apply(self, pending):
+        with q_table_lock():
+            self.recommendation_system.update_q_values_batch(
+                [user for item in pending for user in item.users],
+                [challenge for item in pending for challenge in item.challenges],
+                [reward for item in pending for reward in item.rewards],
+            )
+
+    def _run(self):
+        while True:
+            pending = [self.queue.get()]
+            num_events = len(pending[0])
+            while num_events < self.max_batch:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+                num_events += len(pending[-1])
+
+            start = time.perf_counter()
+            try:
+                self._apply(pending)
+                Q_UPDATES.inc("applied", amount=num_events)
+            except Exception as e:
+                # update_q_values_batch runs every fallible step, the update
+                # log included, before it changes any Q-value; a failed batch
+                # at most allocated user rows, so its requests can be retried
+                # alone without applying any event twice
+                if len(pending) == 1:
+                    pending[0].error = e
+                    Q_UPDATES.inc("failed", amount=num_events)
+                    print(f"Error applying {num_events} Q-value updates: {e}")
+                else:
+                    self._apply_each(pending)
+            finally:
+                Q_UPDATE_BATCH_SECONDS.observe(time.perf_counter() - start)
+                Q_UPDATE_QUEUE_DEPTH.dec(len(pending))
+                for item in pending:
+                    item.applied.set()
+                    self.queue.task_done()
+
+    def _apply_each(self, pending):
+        for item in pending:
+            try:
+                self._apply([item])
+                Q_UPDATES.inc("applied", amount=len(item))
+            except Exception as e:
+                item.error = e
+                Q_UPDATES.inc("failed", amount=len(item))
+                print(f"Error applying {len(item)} Q-value updates: {e}")
+
+
+q_value_writer = QValueWriter(recommendation_system)
+
+
+def user_q_bytes():
+    """Memory held by the user Q-table's values"""
+    user_q = recommendation_system.user_q
+    if isinstance(user_q, loyalty.SparseUserQTable):
+        return user_q.nbytes
+    return user_q.values.nbytes
+
+
+metrics_registry.gauge(
+    "loyalty_user_q_users",
+    "Users with a row in the user Q-table",
+    lambda: len(recommendation_system.user_q),
+)
+metrics_registry.gauge(
+    "loyalty_user_q_bytes", "Bytes of user Q-values in the user Q-table", user_q_bytes
+)
+
+
+def invalid_q_update(user, challenge, reward):
+    """Why an update event cannot be applied, or None if it can"""
+    if not isinstance(user, dict):
+        return "user must be an object"
+    user_id = user.get("user_id")
+    if not isinstance(user_id, (str, int)) or isinstance(user_id, bool):
+        return "user.user_id must be a string or an integer"
+    for field in ("lifetime_purchases", "reviews_written"):
+        value = user.get(field)
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return f"user.{field} must be a number"
+    if challenge not in recommendation_system.catalog:
+        return f"Unknown challenge: {challenge!r}"
+    if not isinstance(reward, (int, float)) or isinstance(reward, bool):
+        return "reward must be a number"
+    if isinstance(reward, float) and not np.isfinite(reward):
+        return "reward must be finite"
+    return None
+
+
+def queue_q_value_updates(users, challenges, rewards, wait=True):
+    """
+    Hand updates to the writer. By default block until they are applied, so
+    the caller reads its own writes; wait=False answers 202 once queued.
+    """
+    for i, event in enumerate(zip(users, challenges, rewards)):
+        error = invalid_q_update(*event)
+        if error is not None:
+            return jsonify({"error": f"Event {i}: {error}"}), 400
+
+    pending = q_value_writer.submit(users, challenges, rewards)
+    if not wait:
+        return jsonify({"message": "Q-value updates queued", "events": len(users)}), 202
+
+    error = pending.wait()
+    if error is not None:
+        return jsonify({"error": f"Q-value update failed: {error}"}), 500
+    return jsonify({"message": "Q-values updated", "events": len(users)})
 
 
 @app.route("/segment_user", methods=["POST"])
@@ -186,6 +426,21 @@ def segment_user():
     return jsonify({"user_segment": segment})
 
 
+@app.route("/segment_users", methods=["POST"])
+def segment_users():
+    """Determine the segments of a list of users in one pass"""
+    users = request.json["users"]
+    segments = loyalty.segment_users(users)
+    return jsonify(
+        {
+            "user_segments": [
+                {"user_id": user.get("user_id"), "user_segment": loyalty.SEGMENTS[s]}
+                for user, s in zip(users, segments.tolist())
+            ]
+        }
+    )
+
+
 @app.route("/select_challenge", methods=["POST"])
 def select_challenge():
     """Select a challenge for the user"""
@@ -194,6 +449,21 @@ def select_challenge():
     return jsonify({"selected_challenge": challenge})
 
 
+@app.route("/select_challenges_batch", methods=["POST"])
+def select_challenges_batch():
+    """Select challenges for a list of users in one pass"""
+    users = request.json["users"]
+    challenges = recommendation_system.select_challenges_batch(users)
+    return jsonify(
+        {
+            "selected_challenges": [
+                {"user_id": user["user_id"], "selected_challenge": challenge}
+                for user, challenge in zip(users, challenges)
+            ]
+        }
+    )
+
+
 @app.route("/simulate_interaction", methods=["POST"])
 def simulate_interaction():
     """Simulate user interaction with a challenge"""
@@ -226,14 +496,43 @@ def calculate_reward():
     return jsonify({"reward": reward})
 
 
+@app.route("/calculate_rewards_batch", methods=["POST"])
+def calculate_rewards_batch():
+    """Calculate the rewards of a list of interactions in one pass"""
+    events = request.json["events"]
+    rewards = recommendation_system.calculate_rewards(
+        [event.get("challenge") for event in events],
+        [event["completed"] for event in events],
+        [event["purchase_made"] for event in events],
+        [event["review_written"] for event in events],
+        [event.get("review_length", 0) for event in events],
+    )
+    return jsonify({"rewards": rewards.tolist()})
+
+
 @app.route("/update_q_values", methods=["POST"])
 def update_q_values():
-    """Update Q-values for a challenge"""
+    """Update the Q-values of a challenge; "wait": false applies it asynchronously"""
     data = request.json
-    recommendation_system.update_q_values(
-        data["user"], data["challenge"], data["reward"]
+    return queue_q_value_updates(
+        [data.get("user")],
+        [data.get("challenge")],
+        [data.get("reward")],
+        data.get("wait", True),
+    )
+
+
+@app.route("/update_q_values_batch", methods=["POST"])
+def update_q_values_batch():
+    """Apply a batch of Q-value update events; "wait": false applies them later"""
+    data = request.json
+    events = data["events"]
+    return queue_q_value_updates(
+        [event.get("user") for event in events],
+        [event.get("challenge") for event in events],
+        [event.get("reward") for event in events],
+        data.get("wait", True),
     )
-    return jsonify({"message": "Q-values updated"})
 
 
 @app.route("/get_insights", methods=["GET"])
@@ -250,14 +549,43 @@ def recommend_challenges():
     user = data["user"]
     num_recommendations = data.get("num_recommendations", 3)
 
-    recommended_challenges = sorted(
-        recommendation_system.challenges.keys(),
-        key=lambda c: recommendation_system.challenge_q_values[c],
-        reverse=True,
-    )[:num_recommendations]
+    recommended_challenges = [
+        recommendation_system.challenge_names[i]
+        for i in recommendation_system.global_ranking()[:num_recommendations]
+    ]
 
     return jsonify({"recommended_challenges": recommended_challenges})
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Service metrics in the Prometheus text format"""
+    return Response(metrics_registry.render(), content_type="text/plain; version=0.0.4")
+
+
+def timed_view(endpoint, view):
+    """Wrap a view to record its own time, net of JSON parsing and serializing"""
+
+    @functools.wraps(view)
+    def timed(*args, **kwargs):
+        g.json_seconds = 0.0
+        start = time.perf_counter()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            STAGE_SECONDS.observe(
+                time.perf_counter() - start - g.json_seconds, endpoint, "handler"
+            )
+
+    return timed
+
+
+for endpoint, view in list(app.view_functions.items()):
+    if endpoint != "static":
+        app.view_functions[endpoint] = timed_view(endpoint, view)
+
+
 if __name__ == "__main__":
+    # Development server only; in production run the pre-fork server:
+    #   gunicorn -c loyalty_gunicorn.conf.py loyaltyAPI:app
     app.run(debug=True)
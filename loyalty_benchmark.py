@@ -0,0 +1,292 @@
+"""
+Micro-benchmarks of the loyalty recommendation system.
+
+    python loyalty_benchmark.py                          # 1K, 100K and 10M users
+    python loyalty_benchmark.py --users 1000 100000 --output bench.json
+    python loyalty_benchmark.py --baseline bench.json    # exit 1 on regressions
+
+Every population is a recommendation system whose user Q-table already holds
+all users with random Q-values, so lookups hit populated rows. Single-call
+benchmarks time each call and report mean, p50 and p99 latency; batch
+benchmarks and the simulation loop also report events per second.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from loyalty import ChallengeRecommendationSystem, run_challenge_simulation_vectorized
+
+BENCHMARK_USERS = [1_000, 100_000, 10_000_000]
+
+
+def build_system(num_users, rng, policy="epsilon_greedy"):
+    """
+    Build a recommendation system with num_users populated user Q-rows.
+
+    Args:
+        num_users: Users in the user Q-table, ids 0 to num_users - 1
+        rng: np.random.Generator for the Q-values
+        policy: Challenge selection policy
+
+    Returns:
+        ChallengeRecommendationSystem: The populated system
+    """
+    recommendation_system = ChallengeRecommendationSystem(policy=policy)
+    num_challenges = len(recommendation_system.catalog)
+
+    user_q = recommendation_system.user_q
+    user_q.values = np.zeros((num_users, num_challenges))
+    user_q.ensure_many(range(num_users))
+    user_q.values[:] = rng.random((num_users, num_challenges)) * 4
+
+    recommendation_system.segments_seen[:] = True
+    recommendation_system.segment_q[:] = rng.random(
+        recommendation_system.segment_q.shape
+    )
+    recommendation_system.global_q[:] = rng.random(num_challenges)
+    return recommendation_system
+
+
+def random_users(num_users, count, rng):
+    """count user dicts drawn from a population of num_users"""
+    user_ids = rng.integers(num_users, size=count).tolist()
+    lifetime_purchases = rng.integers(0, 6, size=count).tolist()
+    reviews_written = rng.integers(0, 3, size=count).tolist()
+    return [
+        {
+            "user_id": user_id,
+            "lifetime_purchases": purchases,
+            "reviews_written": reviews,
+            "challenge_progress": 0,
+        }
+        for user_id, purchases, reviews in zip(
+            user_ids, lifetime_purchases, reviews_written
+        )
+    ]
+
+
+def time_calls(fn, args_list):
+    """Seconds taken by fn(*args) for each args tuple, in order"""
+    seconds = np.empty(len(args_list))
+    for i, args in enumerate(args_list):
+        start = time.perf_counter()
+        fn(*args)
+        seconds[i] = time.perf_counter() - start
+    return seconds
+
+
+def summarize(benchmark, num_users, seconds, events_per_call=1):
+    """Reduce per-call timings to one result row"""
+    return {
+        "benchmark": benchmark,
+        "users": num_users,
+        "calls": len(seconds),
+        "mean_us": seconds.mean() * 1e6,
+        "p50_us": np.percentile(seconds, 50) * 1e6,
+        "p99_us": np.percentile(seconds, 99) * 1e6,
+        "events_per_second": events_per_call * len(seconds) / seconds.sum(),
+    }
+
+
+def benchmark_population(
+    num_users,
+    rng,
+    calls=2000,
+    batch_size=1000,
+    batches=20,
+    sim_iterations=3,
+    policy="epsilon_greedy",
+):
+    """
+    Run every benchmark against one population size.
+
+    Args:
+        num_users: Population size
+        rng: np.random.Generator for users, Q-values and rewards
+        calls: Timed calls per single-call benchmark
+        batch_size: Users or events per batch call
+        batches: Timed calls per batch benchmark
+        sim_iterations: Iterations of the simulation loop, 0 to skip it
+        policy: Challenge selection policy
+
+    Returns:
+        list: One result dict per benchmark
+    """
+    start = time.perf_counter()
+    recommendation_system = build_system(num_users, rng, policy)
+    build_seconds = time.perf_counter() - start
+    challenge_names = recommendation_system.challenge_names
+
+    users = random_users(num_users, calls, rng)
+    challenges = rng.choice(challenge_names, size=calls).tolist()
+    rewards = (rng.random(calls) * 4).tolist()
+
+    results = [
+        summarize("build_population", num_users, np.array([build_seconds]), num_users),
+        summarize(
+            "select_challenge",
+            num_users,
+            time_calls(
+                recommendation_system.select_challenge, [(user,) for user in users]
+            ),
+        ),
+        summarize(
+            "recommend_next_challenges",
+            num_users,
+            time_calls(
+                recommendation_system.recommend_next_challenges,
+                [(user,) for user in users],
+            ),
+        ),
+        summarize(
+            "update_q_values",
+            num_users,
+            time_calls(
+                recommendation_system.update_q_values,
+                list(zip(users, challenges, rewards)),
+            ),
+        ),
+    ]
+
+    batch_users = [random_users(num_users, batch_size, rng) for _ in range(batches)]
+    results.append(
+        summarize(
+            "select_challenges_batch",
+            num_users,
+            time_calls(
+                recommendation_system.select_challenges_batch,
+                [(users,) for users in batch_users],
+            ),
+            batch_size,
+        )
+    )
+    results.append(
+        summarize(
+            "update_q_values_batch",
+            num_users,
+            time_calls(
+                recommendation_system.update_q_values_batch,
+                [
+                    (
+                        users,
+                        rng.choice(challenge_names, size=batch_size).tolist(),
+                        rng.random(batch_size) * 4,
+                    )
+                    for users in batch_users
+                ],
+            ),
+            batch_size,
+        )
+    )
+    del recommendation_system
+
+    if sim_iterations:
+        # Results are streamed to disk, as they would not fit in memory at scale
+        with tempfile.TemporaryDirectory() as results_path:
+            start = time.perf_counter()
+            run_challenge_simulation_vectorized(
+                num_iterations=sim_iterations,
+                num_users=num_users,
+                seed=rng.integers(2**32),
+                results_path=results_path,
+                compact_users=True,
+                policy=policy,
+            )
+            sim_seconds = time.perf_counter() - start
+        results.append(
+            summarize(
+                "simulation_iteration",
+                num_users,
+                np.full(sim_iterations, sim_seconds / sim_iterations),
+                num_users,
+            )
+        )
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Join results with a baseline run on benchmark and population.
+
+    Returns:
+        pd.DataFrame: p50 latencies, their change and a regression flag
+    """
+    merged = pd.DataFrame(results).merge(
+        pd.DataFrame(baseline),
+        on=["benchmark", "users"],
+        suffixes=("", "_baseline"),
+    )
+    merged["p50_change"] = merged["p50_us"] / merged["p50_us_baseline"] - 1
+    merged["regression"] = merged["p50_change"] > tolerance
+    return merged[
+        ["benchmark", "users", "p50_us_baseline", "p50_us", "p50_change", "regression"]
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the loyalty system")
+    parser.add_argument("--users", type=int, nargs="+", default=BENCHMARK_USERS)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--sim-iterations", type=int, default=3)
+    parser.add_argument("--policy", default="epsilon_greedy")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="p50 slowdown over the baseline counted as a regression",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for num_users in args.users:
+        print(f"Benchmarking {num_users} users...", file=sys.stderr)
+        results.extend(
+            benchmark_population(
+                num_users,
+                rng,
+                calls=args.calls,
+                batch_size=args.batch_size,
+                batches=args.batches,
+                sim_iterations=args.sim_iterations,
+                policy=args.policy,
+            )
+        )
+
+    pd.set_option("display.width", 200)
+    print(pd.DataFrame(results).round(2).to_string(index=False))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        comparison = compare_to_baseline(results, baseline, args.tolerance)
+        print("\nCompared to baseline:")
+        print(comparison.round(3).to_string(index=False))
+        if comparison["regression"].any():
+            sys.exit(1)
@@ -0,0 +1,55 @@
+"""
+Production server settings for the loyalty service.
+
+    pip install -r loyalty_requirements.txt
+    gunicorn -c loyalty_gunicorn.conf.py loyaltyAPI:app
+
+Workers are forked processes that share learned Q-values through the
+memory-mapped store in LOYALTY_STORE_PATH. Each worker serves reads from its
+threads without locking and applies writes through its own single writer
+thread, serialized across workers by the store's file lock.
+
+Only the store is shared between workers, so the in-memory user table options
+(LOYALTY_MAX_USERS, LOYALTY_USER_TTL, LOYALTY_SPILL_PATH, LOYALTY_SPARSE_USER_Q)
+are rejected at startup. LOYALTY_SNAPSHOT_PATH seeds the store when it is
+still empty and is ignored afterwards.
+
+Workers keep their metrics in LOYALTY_METRICS_DIR, and /metrics on any worker
+reports the sum over all of them.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("LOYALTY_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("LOYALTY_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.environ.get("LOYALTY_THREADS", 4))
+worker_class = "gthread"
+
+# Import the app after forking so every worker opens its own store handles
+# and starts its own writer thread
+preload_app = False
+
+metrics_dir = os.environ.get("LOYALTY_METRICS_DIR", "loyalty_metrics_data")
+
+raw_env = [
+    f"LOYALTY_STORE_PATH={os.environ.get('LOYALTY_STORE_PATH', 'loyalty_q_store')}",
+    f"LOYALTY_METRICS_DIR={metrics_dir}",
+]
+
+
+# loyalty_metrics is imported in the hooks: the app directory is only on
+# sys.path once gunicorn has loaded this file
+
+
+def on_starting(server):
+    import loyalty_metrics
+
+    # Counters restart from zero with the server, like any Prometheus target
+    loyalty_metrics.clear_directory(metrics_dir)
+
+
+def child_exit(server, worker):
+    import loyalty_metrics
+
+    loyalty_metrics.mark_process_dead(metrics_dir, worker.pid)
@@ -0,0 +1,266 @@
+"""
+HTTP load generator for the loyalty service.
+
+    python loyalty_loadtest.py --spawn                   # local gunicorn instance
+    python loyalty_loadtest.py --url http://127.0.0.1:5000 --duration 30 \\
+        --concurrency 32 --mix select_challenge=8,update_q_values=2
+
+Each client thread holds one keep-alive connection and sends requests back to
+back (closed loop), picking endpoints from a weighted mix. Requests sent
+during the warmup are not recorded. The report gives throughput and p50, p90,
+p99 and max latency per endpoint. Client threads share one interpreter, so
+for high request rates run several load generators side by side.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+
+from loyalty import ChallengeRecommendationSystem
+
+CHALLENGE_NAMES = ChallengeRecommendationSystem().challenge_names
+
+DEFAULT_MIX = {
+    "select_challenge": 6,
+    "recommend_challenges": 2,
+    "update_q_values": 2,
+    "select_challenges_batch": 1,
+}
+
+
+def random_user(rng, num_users):
+    return {
+        "user_id": f"user_{rng.integers(num_users)}",
+        "lifetime_purchases": int(rng.integers(0, 6)),
+        "reviews_written": int(rng.integers(0, 3)),
+        "challenge_progress": 0,
+    }
+
+
+# Request body per endpoint, given an RNG and the simulated population size
+REQUEST_BODIES = {
+    "select_challenge": random_user,
+    "segment_user": random_user,
+    "recommend_challenges": lambda rng, n: {"user": random_user(rng, n)},
+    "select_challenges_batch": lambda rng, n: {
+        "users": [random_user(rng, n) for _ in range(100)]
+    },
+    "update_q_values": lambda rng, n: {
+        "user": random_user(rng, n),
+        "challenge": CHALLENGE_NAMES[rng.integers(len(CHALLENGE_NAMES))],
+        "reward": float(rng.random() * 4),
+    },
+}
+
+
+def parse_mix(text):
+    """Parse endpoint=weight,... into a {endpoint: weight} dict"""
+    mix = {}
+    for item in text.split(","):
+        endpoint, _, weight = item.partition("=")
+        if endpoint not in REQUEST_BODIES:
+            raise ValueError(f"Unknown endpoint {endpoint!r}")
+        mix[endpoint] = float(weight or 1)
+    return mix
+
+
+def run_client(url, mix, num_users, warmup_end, deadline, seed):
+    """
+    Send requests until the deadline from one connection.
+
+    Returns:
+        list: (endpoint, seconds, ok) per request sent after the warmup
+    """
+    rng = np.random.default_rng(seed)
+    endpoints = list(mix)
+    weights = np.array(list(mix.values()), dtype=float)
+    weights /= weights.sum()
+
+    parts = urlsplit(url)
+    headers = {"Content-Type": "application/json"}
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    samples = []
+
+    while True:
+        start = time.perf_counter()
+        if start >= deadline:
+            break
+
+        endpoint = endpoints[rng.choice(len(endpoints), p=weights)]
+        body = json.dumps(REQUEST_BODIES[endpoint](rng, num_users))
+        try:
+            connection.request("POST", f"/{endpoint}", body, headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status < 400
+        except (OSError, http.client.HTTPException):
+            ok = False
+            connection.close()
+            connection = http.client.HTTPConnection(
+                parts.hostname, parts.port, timeout=30
+            )
+
+        if start >= warmup_end:
+            samples.append((endpoint, time.perf_counter() - start, ok))
+
+    connection.close()
+    return samples
+
+
+def run_load(url, mix, duration=10.0, warmup=2.0, concurrency=8, num_users=10_000):
+    """
+    Load a running service from concurrent client threads.
+
+    Args:
+        url: Base URL of the service
+        mix: {endpoint: weight} of the requests to send
+        duration: Seconds measured after the warmup
+        warmup: Seconds of unrecorded requests first
+        concurrency: Client threads, each with its own connection
+        num_users: Distinct user_ids requests are drawn from
+
+    Returns:
+        pd.DataFrame: One row per endpoint plus a total row
+    """
+    start = time.perf_counter()
+    warmup_end = start + warmup
+    deadline = warmup_end + duration
+
+    samples = [None] * concurrency
+
+    def client(i):
+        samples[i] = run_client(url, mix, num_users, warmup_end, deadline, seed=i)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    requests = pd.DataFrame(
+        [sample for client_samples in samples for sample in client_samples],
+        columns=["endpoint", "seconds", "ok"],
+    )
+    return summarize_requests(requests, duration)
+
+
+def summarize_requests(requests, duration):
+    """Throughput and latency percentiles per endpoint and in total"""
+    rows = []
+    groups = list(requests.groupby("endpoint")) + [("total", requests)]
+    for endpoint, group in groups:
+        milliseconds = group["seconds"].to_numpy() * 1000
+        rows.append(
+            {
+                "endpoint": endpoint,
+                "requests": len(group),
+                "errors": int((~group["ok"]).sum()),
+                "requests_per_second": len(group) / duration,
+                "p50_ms": np.percentile(milliseconds, 50) if len(group) else np.nan,
+                "p90_ms": np.percentile(milliseconds, 90) if len(group) else np.nan,
+                "p99_ms": np.percentile(milliseconds, 99) if len(group) else np.nan,
+                "max_ms": milliseconds.max() if len(group) else np.nan,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def spawn_server(port, workers, threads, store_path):
+    """
+    Start the service under gunicorn with the production settings.
+
+    Returns:
+        subprocess.Popen: The server, ready to take requests
+    """
+    env = {
+        **os.environ,
+        "LOYALTY_BIND": f"127.0.0.1:{port}",
+        "LOYALTY_WORKERS": str(workers),
+        "LOYALTY_THREADS": str(threads),
+        "LOYALTY_STORE_PATH": store_path,
+    }
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-c",
+            "loyalty_gunicorn.conf.py",
+            "loyaltyAPI:app",
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/metrics")
+            if connection.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 60 seconds")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the loyalty service")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument(
+        "--spawn",
+        action="store_true",
+        help="Start a local gunicorn instance on the --url port with a fresh store",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="Weighted endpoints, e.g. select_challenge=8,update_q_values=2",
+    )
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    with tempfile.TemporaryDirectory() as store_path:
+        if args.spawn:
+            port = urlsplit(args.url).port or 80
+            server = spawn_server(port, args.workers, args.threads, store_path)
+        try:
+            report = run_load(
+                args.url,
+                args.mix,
+                duration=args.duration,
+                warmup=args.warmup,
+                concurrency=args.concurrency,
+                num_users=args.users,
+            )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    pd.set_option("display.width", 200)
+    print(report.round(3).to_string(index=False))
+
+    if args.output:
+        report.to_json(args.output, orient="records", indent=2)
@@ -0,0 +1,370 @@
+"""
+In-process metrics for the loyalty service in the Prometheus text format.
+
+The service runs as several pre-forked workers and a scrape reaches only one
+of them, so with a metrics directory every worker keeps its counters and
+histograms in its own memory-mapped file there, and a scrape sums the files
+of all workers, as prometheus_client's multiprocess mode does. Files of
+exited workers are kept so counters never go backwards. Set-style gauges
+live in a separate file per worker that is deleted when the worker exits
+(mark_process_dead), so they sum over live workers only. Without a directory
+values are kept in memory, which is enough for a single process.
+
+Recording is a bucket search and a few float additions under a lock, cheap
+enough to run on every request.
+"""
+
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+
+# Latency buckets in seconds, from sub-millisecond scoring to slow requests
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+_INITIAL_FILE_SIZE = 1 << 16
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = [*zip(labelnames, labels), *extra]
+    if not pairs:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, value in pairs
+    )
+    return (
+        "{"
+        + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped))
+        + "}"
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _LocalValues:
+    """Float values by (name, sample, labels) key, in memory"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class _MmapValues:
+    """
+    Float values by (name, sample, labels) key in a file only this process
+    writes. Layout: the used byte count (uint64), then one entry per key of
+    key length (uint32), JSON key padded to 8 bytes and value (float64). The
+    used count is written after each new entry, so readers in other processes
+    never see a partial one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._positions = {}
+        self._lock = threading.Lock()
+
+        self._file = open(path, "a+b")
+        # A file left by an exited process with the same pid is continued
+        if os.path.getsize(path) < 8:
+            self._file.truncate(_INITIAL_FILE_SIZE)
+        self._mmap = mmap.mmap(self._file.fileno(), os.path.getsize(path))
+        self._used = max(8, struct.unpack_from("<Q", self._mmap, 0)[0])
+        for key, _, position in _read_entries(self._mmap):
+            self._positions[key] = position
+
+    def add(self, key, amount):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._append(key)
+            (value,) = struct.unpack_from("<d", self._mmap, position)
+            struct.pack_into("<d", self._mmap, position, value + amount)
+
+    def _append(self, key):
+        name, sample, labels = key
+        encoded = json.dumps([name, sample, [str(label) for label in labels]]).encode()
+        padding = -(4 + len(encoded)) % 8
+        entry_size = 4 + len(encoded) + padding + 8
+
+        if self._used + entry_size > len(self._mmap):
+            size = len(self._mmap)
+            while self._used + entry_size > size:
+                size *= 2
+            self._mmap.close()
+            self._file.truncate(size)
+            self._mmap = mmap.mmap(self._file.fileno(), size)
+
+        position = self._used
+        struct.pack_into("<I", self._mmap, position, len(encoded))
+        self._mmap[position + 4 : position + 4 + len(encoded)] = encoded
+        value_position = position + entry_size - 8
+        struct.pack_into("<d", self._mmap, value_position, 0.0)
+        self._used += entry_size
+        struct.pack_into("<Q", self._mmap, 0, self._used)
+
+        self._positions[key] = value_position
+        return value_position
+
+
+def _read_entries(buffer):
+    """(key, value, value position) of every complete entry of a values file"""
+    used = struct.unpack_from("<Q", buffer, 0)[0]
+    position = 8
+    while position < used:
+        (length,) = struct.unpack_from("<I", buffer, position)
+        key = bytes(buffer[position + 4 : position + 4 + length])
+        name, sample, labels = json.loads(key)
+        position += 4 + length
+        position += -position % 8
+        (value,) = struct.unpack_from("<d", buffer, position)
+        yield (name, sample, tuple(labels)), value, position
+        position += 8
+
+
+def _read_values(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < 8:
+        return
+    for key, value, _ in _read_entries(data):
+        yield key, value
+
+
+def mark_process_dead(directory, pid):
+    """Drop the live gauge values of an exited worker; its counters are kept"""
+    try:
+        os.remove(os.path.join(directory, f"live_{pid}.db"))
+    except FileNotFoundError:
+        pass
+
+
+def clear_directory(directory):
+    """Remove the values files of a previous server run"""
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.db")):
+        os.remove(path)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=(), values=None):
+        """
+        Monotonic count per label combination.
+
+        Args:
+            name: Metric name
+            documentation: HELP text
+            labelnames: Names of the labels passed to inc
+            values: Value storage, in memory by default
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = values if values is not None else _LocalValues()
+
+    def inc(self, *labels, amount=1):
+        self._values.add((self.name, "", labels), amount)
+
+    def render(self, samples):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for (_, labels), value in samples.items():
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labels)} "
+                f"{_format_value(value)}"
+            )
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, values=None
+    ):
+        """
+        Bucketed distribution per label combination.
+
+        Args:
+            name: Metric name
+            documentation: HELP text
+            labelnames: Names of the labels passed to observe
+            buckets: Sorted upper bounds, +Inf is implied
+            values: Value storage, in memory by default
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Samples are the count of each bucket by index (last is +Inf) and "sum"
+        self._values = values if values is not None else _LocalValues()
+
+    def observe(self, value, *labels):
+        bucket = bisect_left(self.buckets, value)
+        self._values.add((self.name, bucket, labels), 1)
+        self._values.add((self.name, "sum", labels), value)
+
+    def render(self, samples):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        series = {}
+        for (sample, labels), value in samples.items():
+            counts, total = series.setdefault(
+                labels, ([0.0] * (len(self.buckets) + 1), [0.0])
+            )
+            if sample == "sum":
+                total[0] += value
+            else:
+                counts[sample] += value
+
+        for labels, (counts, (total,)) in series.items():
+            cumulative = 0.0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _format_labels(self.labelnames, labels, (("le", le),))
+                lines.append(
+                    f"{self.name}_bucket{bucket_labels} {_format_value(cumulative)}"
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {_format_value(cumulative)}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation, callback=None, values=None):
+        """
+        Current value, summed over live workers.
+
+        With a callback the value is read at scrape time in the worker that
+        serves the scrape, so nothing is recorded on the hot path; use it for
+        state every worker shares, such as the memory-mapped Q-table store.
+        Without one, workers record their own share with inc and dec.
+
+        Args:
+            name: Metric name
+            documentation: HELP text
+            callback: Returns the current value
+            values: Value storage for inc/dec, in memory by default
+        """
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self._values = values if values is not None else _LocalValues()
+
+    def inc(self, amount=1):
+        self._values.add((self.name, "", ()), amount)
+
+    def dec(self, amount=1):
+        self._values.add((self.name, "", ()), -amount)
+
+    def render(self, samples):
+        if self.callback is not None:
+            value = self.callback()
+        else:
+            value = sum(samples.values())
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_format_value(value)}",
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self, directory=None):
+        """
+        Registry of the metrics of one process.
+
+        Args:
+            directory: Directory shared by all worker processes for their
+                values files, None to keep values in this process only.
+                Create the registry after forking: files are named by pid.
+        """
+        self.directory = directory
+        self.metrics = []
+        if directory is None:
+            self._values = self._live_values = _LocalValues()
+        else:
+            os.makedirs(directory, exist_ok=True)
+            pid = os.getpid()
+            self._values = _MmapValues(os.path.join(directory, f"values_{pid}.db"))
+            self._live_values = _MmapValues(os.path.join(directory, f"live_{pid}.db"))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(
+            Counter(name, documentation, labelnames, self._values)
+        )
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(
+            Histogram(name, documentation, labelnames, buckets, self._values)
+        )
+
+    def gauge(self, name, documentation, callback=None):
+        return self.register(
+            Gauge(name, documentation, callback, self._live_values)
+        )
+
+    def _collect(self):
+        """Samples by metric name, summed over the values files of all workers"""
+        if self.directory is None:
+            items = self._values.items()
+        else:
+            items = [
+                item
+                for path in glob.glob(os.path.join(self.directory, "*.db"))
+                for item in _read_values(path)
+            ]
+
+        samples = {}
+        for (name, sample, labels), value in items:
+            series = samples.setdefault(name, {})
+            series[sample, labels] = series.get((sample, labels), 0.0) + value
+        return samples
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        samples = self._collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(samples.get(metric.name, {})))
+        return "\n".join(lines) + "\n"
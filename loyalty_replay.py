@@ -0,0 +1,205 @@
+"""
+Offline replay of logged events into a ChallengeRecommendationSystem.
+
+An event log is read in chunks and every chunk is applied as one grouped,
+vectorized Q-value update that is equivalent to applying its events one at a
+time in log order. Supported logs:
+    *.jsonl / *.json    one JSON event per line, e.g. the Q-table store's
+                        updates.jsonl
+    *.parquet           needs pyarrow
+    directory           a results directory written by ResultsWriter
+
+Each event needs user_id and challenge (name or id), a segment name or the
+user's lifetime_purchases and reviews_written, and a reward. With
+recompute_rewards, or when there is no reward column, rewards are recomputed
+from completed, purchase_made, review_written and review_length, so a reward
+formula change is applied to history by replaying it. Events with an engaged
+flag of false still update Q-values but are not counted as attempts.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from loyalty import SEGMENTS, ChallengeRecommendationSystem, segment_codes
+from loyalty_results import (
+    is_results_directory,
+    iter_result_chunks,
+    read_results_meta,
+)
+
+
+def iter_event_chunks(path, chunk_rows=1_000_000):
+    """
+    Yield an event log as DataFrame chunks.
+
+    Args:
+        path: JSONL or Parquet file, or a results directory
+        chunk_rows: Events per chunk
+
+    Yields:
+        pd.DataFrame: Up to chunk_rows events, in log order
+    """
+    if is_results_directory(path):
+        meta = read_results_meta(path)
+        user_ids = np.load(os.path.join(path, "user_ids.npy")).astype(object)
+        for chunk in iter_result_chunks(path):
+            events = pd.DataFrame(chunk)
+            events["user_id"] = user_ids[chunk["user"]]
+            events["segment"] = pd.Categorical.from_codes(
+                chunk["segment"], meta["segments"]
+            )
+            # Result chunks store challenge ids in the run's catalog order
+            events["challenge"] = np.asarray(meta["challenges"], dtype=object)[
+                chunk["challenge"]
+            ]
+            yield events
+
+    elif path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Replaying Parquet event logs requires pyarrow") from e
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            events = batch.to_pandas()
+            # Plain Python ids, equal to the keys the service looks users up by
+            events["user_id"] = events["user_id"].astype(object)
+            yield events
+
+    else:
+        # Keep user ids as logged: inference would turn "123" into the int 123
+        with pd.read_json(
+            path, lines=True, chunksize=chunk_rows, dtype={"user_id": object}
+        ) as reader:
+            yield from reader
+
+
+def replay_chunk(recommendation_system, events, recompute_rewards=False):
+    """
+    Apply one chunk of events, in order, to a recommendation system.
+
+    Args:
+        recommendation_system: ChallengeRecommendationSystem to update
+        events: DataFrame of events, see the module docstring
+        recompute_rewards: Recompute rewards with calculate_rewards instead of
+            using the logged ones
+
+    Returns:
+        int: Number of events applied
+    """
+    events = events[events["challenge"].notna()]
+    if events.empty:
+        return 0
+
+    user_codes, unique_users = pd.factorize(events["user_id"])
+    user_rows = recommendation_system.user_q.ensure_many(unique_users.tolist())[
+        user_codes
+    ]
+
+    challenge_codes, unique_challenges = pd.factorize(events["challenge"])
+    challenge_idx = recommendation_system.catalog.ids_of(unique_challenges.tolist())[
+        challenge_codes
+    ]
+
+    if "segment" in events:
+        segments = pd.Categorical(events["segment"], categories=SEGMENTS).codes
+        if (segments < 0).any():
+            raise ValueError("Event log contains unknown segments")
+        segments = segments.astype(np.intp)
+    else:
+        segments = segment_codes(
+            events["lifetime_purchases"].to_numpy(),
+            events["reviews_written"].to_numpy(),
+        )
+
+    if recompute_rewards or "reward" not in events:
+        rewards = recommendation_system.calculate_rewards(
+            challenge_idx,
+            events["completed"].to_numpy(dtype=bool),
+            events["purchase_made"].to_numpy(dtype=bool),
+            events["review_written"].to_numpy(dtype=bool),
+            events["review_length"].to_numpy(),
+        )
+    else:
+        rewards = events["reward"].to_numpy(dtype=float)
+
+    recommendation_system.apply_q_updates(user_rows, segments, challenge_idx, rewards)
+
+    if "completed" in events:
+        engaged = (
+            events["engaged"].to_numpy(dtype=bool)
+            if "engaged" in events
+            else np.ones(len(events), dtype=bool)
+        )
+        recommendation_system.record_interactions(
+            challenge_idx[engaged], events["completed"].to_numpy(dtype=bool)[engaged]
+        )
+
+    return len(events)
+
+
+def replay_events(
+    path,
+    recommendation_system=None,
+    recompute_rewards=False,
+    chunk_rows=1_000_000,
+    verbose=False,
+):
+    """
+    Rebuild Q-tables and counters by replaying an event log.
+
+    Args:
+        path: JSONL or Parquet file, or a results directory
+        recommendation_system: System to replay into, a new
+            ChallengeRecommendationSystem by default
+        recompute_rewards: Recompute rewards from the interaction columns
+        chunk_rows: Events applied per grouped update
+        verbose: Print progress per chunk
+
+    Returns:
+        ChallengeRecommendationSystem: The updated system
+    """
+    if recommendation_system is None:
+        recommendation_system = ChallengeRecommendationSystem()
+
+    # Replayed events are already in the log, don't record them again
+    update_log = recommendation_system.update_log
+    recommendation_system.update_log = None
+    try:
+        num_events = 0
+        for events in iter_event_chunks(path, chunk_rows):
+            num_events += replay_chunk(recommendation_system, events, recompute_rewards)
+            if verbose:
+                print(f"Replayed {num_events} events")
+    finally:
+        recommendation_system.update_log = update_log
+
+    return recommendation_system
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from loyalty_snapshot import save_snapshot
+
+    parser = argparse.ArgumentParser(description="Replay an event log offline")
+    parser.add_argument("events", help="JSONL or Parquet file, or results directory")
+    parser.add_argument("snapshot", help="Snapshot file to write the result to")
+    parser.add_argument("--recompute-rewards", action="store_true")
+    parser.add_argument("--chunk-rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    recommendation_system = replay_events(
+        args.events,
+        recompute_rewards=args.recompute_rewards,
+        chunk_rows=args.chunk_rows,
+        verbose=True,
+    )
+    save_snapshot(recommendation_system, args.snapshot)
+
+    print("\nChallenge Completion Rates:")
+    insights = recommendation_system.get_challenge_insights()
+    for challenge, rate in insights["completion_rates"].items():
+        print(f"  {challenge}: {rate*100:.1f}%")
@@ -0,0 +1,363 @@
+"""
+Chunked, columnar storage and streaming aggregation of simulation results.
+
+A results directory holds:
+    meta.json          segment and challenge names the code columns index
+    user_ids.npy       user_id per user index
+    chunk_000000.npz   one batch of rows per file, one array per column
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+RESULT_COLUMNS = {
+    "iteration": np.int32,
+    "user": np.int64,
+    "segment": np.int8,
+    "challenge": np.int16,
+    "completed": np.bool_,
+    "purchase_made": np.bool_,
+    "review_written": np.bool_,
+    "review_length": np.int32,
+    "reward": np.float64,
+    "engaged": np.bool_,
+}
+
+
+def is_results_directory(results):
+    return isinstance(results, (str, os.PathLike)) and os.path.isdir(results)
+
+
+class ResultsWriter:
+    def __init__(
+        self, directory, user_ids, segment_names, challenge_names, chunk_rows=1_000_000
+    ):
+        """
+        Write simulation results to a directory in fixed-size columnar chunks.
+
+        Args:
+            directory: Output directory, created if missing
+            user_ids: user_id per user index
+            segment_names: Names indexed by the segment column
+            challenge_names: Names indexed by the challenge column
+            chunk_rows: Rows buffered in memory before a chunk is written
+        """
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self._buffer = []
+        self._buffered_rows = 0
+        self._num_chunks = 0
+
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "user_ids.npy"), np.asarray(user_ids))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "segments": list(segment_names),
+                    "challenges": list(challenge_names),
+                },
+                f,
+            )
+
+    def append(self, **columns):
+        """Buffer one batch of rows, given as one array per RESULT_COLUMNS name"""
+        batch = {
+            name: np.asarray(columns[name], dtype=dtype)
+            for name, dtype in RESULT_COLUMNS.items()
+        }
+        self._buffer.append(batch)
+        self._buffered_rows += len(batch["iteration"])
+
+        if self._buffered_rows >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows as a new chunk"""
+        if not self._buffer:
+            return
+
+        chunk = {
+            name: np.concatenate([batch[name] for batch in self._buffer])
+            for name in RESULT_COLUMNS
+        }
+        np.savez(
+            os.path.join(self.directory, f"chunk_{self._num_chunks:06d}.npz"), **chunk
+        )
+        self._num_chunks += 1
+        self._buffer = []
+        self._buffered_rows = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def read_results_meta(directory):
+    with open(os.path.join(directory, "meta.json")) as f:
+        return json.load(f)
+
+
+def iter_result_chunks(directory):
+    """Yield each chunk of a results directory as a dict of code arrays"""
+    for path in sorted(glob.glob(os.path.join(directory, "chunk_*.npz"))):
+        with np.load(path) as chunk:
+            yield {name: chunk[name] for name in RESULT_COLUMNS}
+
+
+def load_results(directory):
+    """Load a whole results directory into the in-memory results DataFrame layout"""
+    meta = read_results_meta(directory)
+    user_ids = np.load(os.path.join(directory, "user_ids.npy")).astype(object)
+    segment_names = meta["segments"]
+    challenge_names = meta["challenges"]
+
+    frames = [
+        pd.DataFrame(
+            {
+                "iteration": chunk["iteration"],
+                "user_id": user_ids[chunk["user"]],
+                "segment": pd.Categorical.from_codes(chunk["segment"], segment_names),
+                "challenge": pd.Categorical.from_codes(
+                    chunk["challenge"], challenge_names
+                ),
+                "completed": chunk["completed"],
+                "purchase_made": chunk["purchase_made"],
+                "review_written": chunk["review_written"],
+                "review_length": chunk["review_length"],
+                "reward": chunk["reward"],
+                "engaged": chunk["engaged"],
+            }
+        )
+        for chunk in iter_result_chunks(directory)
+    ]
+    if not frames:
+        return pd.DataFrame(
+            columns=["user_id" if name == "user" else name for name in RESULT_COLUMNS]
+        )
+    return pd.concat(frames, ignore_index=True)
+
+
+class ResultsAggregator:
+    def __init__(self, segment_names, challenge_names):
+        """
+        Grouped sums over result rows, updated batch by batch.
+
+        Args:
+            segment_names: Names indexed by segment codes
+            challenge_names: Names indexed by challenge codes
+        """
+        self.segment_names = list(segment_names)
+        self.challenge_names = list(challenge_names)
+        num_segments = len(self.segment_names)
+        num_challenges = len(self.challenge_names)
+
+        self.rows = 0
+        self.engaged = 0
+        self.segment_rows = np.zeros(num_segments, dtype=np.int64)
+        self.segment_engaged = np.zeros(num_segments, dtype=np.int64)
+        self.challenge_rows = np.zeros(num_challenges, dtype=np.int64)
+        self.challenge_engaged = np.zeros(num_challenges, dtype=np.int64)
+        self.challenge_engaged_completed = np.zeros(num_challenges, dtype=np.int64)
+        self.challenge_purchases = np.zeros(num_challenges, dtype=np.int64)
+
+        self.reviews = 0
+        self.challenge_reviews = np.zeros(num_challenges, dtype=np.int64)
+        self.challenge_review_length = np.zeros(num_challenges)
+        self.segment_reviews = np.zeros(num_segments, dtype=np.int64)
+        self.segment_review_length = np.zeros(num_segments)
+
+        # Running means and co-moments of (review_length, reward) over reviews
+        self._length_mean = 0.0
+        self._reward_mean = 0.0
+        self._length_m2 = 0.0
+        self._reward_m2 = 0.0
+        self._comoment = 0.0
+
+    def add(
+        self,
+        segment,
+        challenge,
+        completed,
+        purchase_made,
+        review_written,
+        review_length,
+        reward,
+        engaged,
+    ):
+        """Fold one batch of rows, given as code and flag arrays, into the sums"""
+        num_segments = len(self.segment_names)
+        num_challenges = len(self.challenge_names)
+        engaged = np.asarray(engaged, dtype=bool)
+        review_written = np.asarray(review_written, dtype=bool)
+
+        self.rows += len(engaged)
+        self.engaged += int(engaged.sum())
+        self.segment_rows += np.bincount(segment, minlength=num_segments)
+        self.segment_engaged += np.bincount(segment[engaged], minlength=num_segments)
+        self.challenge_rows += np.bincount(challenge, minlength=num_challenges)
+        self.challenge_engaged += np.bincount(
+            challenge[engaged], minlength=num_challenges
+        )
+        self.challenge_engaged_completed += np.bincount(
+            challenge[engaged & np.asarray(completed, dtype=bool)],
+            minlength=num_challenges,
+        )
+        self.challenge_purchases += np.bincount(
+            challenge[np.asarray(purchase_made, dtype=bool)], minlength=num_challenges
+        )
+
+        lengths = np.asarray(review_length, dtype=float)[review_written]
+        rewards = np.asarray(reward, dtype=float)[review_written]
+        self.challenge_reviews += np.bincount(
+            challenge[review_written], minlength=num_challenges
+        )
+        self.challenge_review_length += np.bincount(
+            challenge[review_written], weights=lengths, minlength=num_challenges
+        )
+        self.segment_reviews += np.bincount(
+            segment[review_written], minlength=num_segments
+        )
+        self.segment_review_length += np.bincount(
+            segment[review_written], weights=lengths, minlength=num_segments
+        )
+        self._add_review_moments(lengths, rewards)
+
+    def _add_review_moments(self, lengths, rewards):
+        count = len(lengths)
+        if count == 0:
+            return
+
+        # Pairwise merge of co-moments (Chan et al.), stable over many chunks
+        length_mean = lengths.mean()
+        reward_mean = rewards.mean()
+        total = self.reviews + count
+        length_delta = length_mean - self._length_mean
+        reward_delta = reward_mean - self._reward_mean
+        weight = self.reviews * count / total
+
+        self._length_m2 += (
+            (lengths - length_mean) ** 2
+        ).sum() + length_delta**2 * weight
+        self._reward_m2 += (
+            (rewards - reward_mean) ** 2
+        ).sum() + reward_delta**2 * weight
+        self._comoment += (
+            (lengths - length_mean) * (rewards - reward_mean)
+        ).sum() + length_delta * reward_delta * weight
+        self._length_mean += length_delta * count / total
+        self._reward_mean += reward_delta * count / total
+        self.reviews = total
+
+    @staticmethod
+    def _rates(names, numerators, denominators, scale=1.0):
+        return {
+            name: scale * numerator / denominator
+            for name, numerator, denominator in zip(
+                names, numerators.tolist(), denominators.tolist()
+            )
+            if denominator > 0
+        }
+
+    def metrics(self):
+        """
+        Reduce the sums to the grouped metrics of the results analysis.
+
+        Returns:
+            dict: Rates in percent for engagement, fractions otherwise; review
+            metrics are present only when at least one review was written
+        """
+        metrics = {
+            "overall_engagement": (
+                100.0 * self.engaged / self.rows if self.rows else float("nan")
+            ),
+            "segment_engagement": self._rates(
+                self.segment_names, self.segment_engaged, self.segment_rows, 100.0
+            ),
+            "challenge_engagement": self._rates(
+                self.challenge_names,
+                self.challenge_engaged,
+                self.challenge_rows,
+                100.0,
+            ),
+            "challenge_abandonment": {
+                challenge: 1 - rate
+                for challenge, rate in self._rates(
+                    self.challenge_names,
+                    self.challenge_engaged_completed,
+                    self.challenge_engaged,
+                ).items()
+            },
+            "purchase_rates": (
+                self._rates(
+                    self.challenge_names, self.challenge_purchases, self.challenge_rows
+                )
+                if self.challenge_purchases.any()
+                else {}
+            ),
+        }
+
+        if self.reviews:
+            metrics["avg_review_length"] = self._length_mean
+            metrics["challenge_review_lengths"] = self._rates(
+                self.challenge_names,
+                self.challenge_review_length,
+                self.challenge_reviews,
+            )
+            metrics["segment_review_lengths"] = self._rates(
+                self.segment_names, self.segment_review_length, self.segment_reviews
+            )
+            if self.reviews > 1:
+                denominator = np.sqrt(self._length_m2 * self._reward_m2)
+                metrics["review_length_reward_correlation"] = (
+                    self._comoment / denominator if denominator > 0 else float("nan")
+                )
+
+        return metrics
+
+
+def aggregate_results_frame(results):
+    """Aggregate an in-memory results DataFrame in a single grouped pass"""
+    segment, segment_names = pd.factorize(results["segment"], use_na_sentinel=False)
+    challenge, challenge_names = pd.factorize(
+        results["challenge"], use_na_sentinel=False
+    )
+
+    aggregator = ResultsAggregator(segment_names, challenge_names)
+    aggregator.add(
+        segment,
+        challenge,
+        results["completed"].to_numpy(),
+        results["purchase_made"].to_numpy(),
+        results["review_written"].to_numpy(),
+        results["review_length"].to_numpy(),
+        results["reward"].to_numpy(),
+        results["engaged"].to_numpy(),
+    )
+    return aggregator
+
+
+def aggregate_results_directory(directory):
+    """Stream every chunk of a results directory through a ResultsAggregator"""
+    meta = read_results_meta(directory)
+    aggregator = ResultsAggregator(meta["segments"], meta["challenges"])
+    for chunk in iter_result_chunks(directory):
+        aggregator.add(
+            chunk["segment"],
+            chunk["challenge"],
+            chunk["completed"],
+            chunk["purchase_made"],
+            chunk["review_written"],
+            chunk["review_length"],
+            chunk["reward"],
+            chunk["engaged"],
+        )
+    return aggregator
@@ -0,0 +1,202 @@
+"""
+Snapshot and restore of a trained ChallengeRecommendationSystem.
+
+A snapshot is a single uncompressed .npz file:
+    meta.npy               JSON: format version, challenge catalog, rates
+    global_q.npy           challenges
+    segment_q.npy          segments x challenges
+    segments_seen.npy      segments
+    q_versions.npy         change counters of the global and segment rows
+    attempt_counts.npy     simulated attempts per challenge
+    completion_counts.npy  simulated completions per challenge
+    pull_counts.npy        segments x challenges update counts and
+    reward_sums.npy        reward sums of the bandit policies
+    user_ids.npy           user_id per user row
+    user_q.npy             users x challenges, for a dense user table
+    user_q_keys.npy        sorted row * challenges + challenge keys and
+    user_q_data.npy        their values, for a sparse user table
+
+Members are stored uncompressed, so a snapshot is restored by memory-mapping
+each array in place (copy-on-write): a replica starts serving before any of
+the Q-values have been read from disk.
+"""
+
+import json
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+from loyalty import (
+    SEGMENTS,
+    ChallengeCatalog,
+    ChallengeRecommendationSystem,
+    SparseUserQTable,
+    UserQTable,
+)
+
+SNAPSHOT_VERSION = 1
+
+_SYSTEM_ARRAYS = [
+    "global_q",
+    "segment_q",
+    "segments_seen",
+    "q_versions",
+    "attempt_counts",
+    "completion_counts",
+    "pull_counts",
+    "reward_sums",
+]
+
+
+def save_snapshot(recommendation_system, path):
+    """
+    Write the learned state of a recommendation system to a snapshot file.
+
+    The file is written next to path and renamed into place, so readers
+    never see a partial snapshot.
+
+    Args:
+        recommendation_system: ChallengeRecommendationSystem to save
+        path: Snapshot file to write
+    """
+    user_q = recommendation_system.user_q
+    user_ids = list(user_q)
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "challenges": recommendation_system.challenges,
+        "challenge_order": recommendation_system.challenge_names,
+        "segments": SEGMENTS,
+        "exploration_rate": recommendation_system.exploration_rate,
+        "learning_rate": recommendation_system.learning_rate,
+        "policy": recommendation_system.policy,
+        "user_q_format": "sparse" if isinstance(user_q, SparseUserQTable) else "dense",
+    }
+    arrays = {
+        name: np.asarray(getattr(recommendation_system, name))
+        for name in _SYSTEM_ARRAYS
+    }
+    # Plain strings are stored as-is, other ids JSON encoded to keep their type
+    if all(isinstance(user_id, str) for user_id in user_ids):
+        arrays["user_ids"] = np.array(user_ids, dtype=str)
+    else:
+        meta["user_ids_json"] = True
+        arrays["user_ids"] = np.array([json.dumps(u) for u in user_ids], dtype=str)
+
+    arrays["meta"] = np.array(json.dumps(meta))
+
+    if isinstance(user_q, SparseUserQTable):
+        # Renumber rows to user_ids order and pack in pending pairs
+        rows = user_q.find_many(user_ids)
+        new_row = np.empty(len(user_q.index), dtype=np.int64)
+        new_row[rows] = np.arange(len(rows))
+        keys, data = user_q.packed()
+        num_challenges = user_q.num_challenges
+        keys = new_row[keys // num_challenges] * num_challenges + keys % num_challenges
+        order = np.argsort(keys, kind="stable")
+        arrays["user_q_keys"] = keys[order]
+        arrays["user_q_data"] = data[order]
+    else:
+        arrays["user_q"] = user_q.values_of(user_ids)
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, path)
+
+
+def _read_npz(path, mmap):
+    if not mmap:
+        with np.load(path) as snapshot:
+            return {name: snapshot[name] for name in snapshot.files}
+
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            name = info.filename[: -len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Snapshot member {name} is compressed")
+
+            # Skip the member's local file header to the start of its .npy data
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack("<26xHH", f.read(30))
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    path,
+                    dtype=dtype,
+                    mode="c",
+                    offset=f.tell(),
+                    shape=shape,
+                    order="F" if fortran_order else "C",
+                )
+    return arrays
+
+
+def load_snapshot(path, recommendation_system=None, mmap=True):
+    """
+    Restore a recommendation system from a snapshot file.
+
+    Args:
+        path: Snapshot file written by save_snapshot
+        recommendation_system: System to restore into, which must use the
+            snapshot's challenge catalog; by default a new
+            ChallengeRecommendationSystem with the snapshot's catalog and rates
+        mmap: Map arrays copy-on-write instead of reading them into memory
+
+    Returns:
+        ChallengeRecommendationSystem: The restored system
+    """
+    arrays = _read_npz(path, mmap)
+    meta = json.loads(str(arrays.pop("meta")[()]))
+    if meta["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {meta['version']}")
+    if meta["segments"] != SEGMENTS:
+        raise ValueError(f"Snapshot {path} was built for different segments")
+
+    challenges = {name: meta["challenges"][name] for name in meta["challenge_order"]}
+    if recommendation_system is None:
+        recommendation_system = ChallengeRecommendationSystem(
+            exploration_rate=meta["exploration_rate"],
+            learning_rate=meta["learning_rate"],
+            policy=meta.get("policy", "epsilon_greedy"),
+        )
+        recommendation_system.challenges = challenges
+        recommendation_system.catalog = ChallengeCatalog(challenges)
+        recommendation_system.challenge_names = recommendation_system.catalog.names
+        recommendation_system.challenge_index = recommendation_system.catalog.index
+    elif recommendation_system.challenge_names != meta["challenge_order"]:
+        raise ValueError(f"Snapshot {path} was built for a different challenge catalog")
+
+    for name in _SYSTEM_ARRAYS:
+        # Snapshots from before the bandit policies lack their statistics
+        if name in arrays:
+            setattr(recommendation_system, name, arrays[name])
+
+    user_ids = arrays["user_ids"].tolist()
+    if meta.get("user_ids_json"):
+        user_ids = [json.loads(user_id) for user_id in user_ids]
+    num_challenges = len(recommendation_system.catalog)
+    if meta["user_q_format"] == "sparse":
+        user_q = SparseUserQTable(num_challenges)
+        user_q.keys = arrays["user_q_keys"]
+        user_q.data = arrays["user_q_data"]
+    else:
+        user_q = UserQTable(num_challenges, initial_capacity=0)
+        user_q.values = arrays["user_q"]
+    user_q.index = {user_id: row for row, user_id in enumerate(user_ids)}
+
+    recommendation_system.user_q = user_q
+    recommendation_system._ranking_cache = {}
+    return recommendation_system
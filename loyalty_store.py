@@ -0,0 +1,557 @@
+"""
+Persistent, memory-mapped Q-table storage for the loyalty service.
+
+Every worker process maps the same files, so reads are zero-copy and a
+restarted worker picks up the learned Q-values immediately.
+
+Layout of a store directory:
+    meta.json         version plus the challenge/segment order of the tables
+    global_q.f64      challenges
+    segment_q.f64     segments x challenges
+    segments_seen.u8  segments
+    q_versions.i64    change counters of the global and segment rows
+    pull_counts.i64   segments x challenges update counts and
+    reward_sums.f64   reward sums of the bandit policies
+    user_q.f64        users x challenges, grown in place
+    user_ids.jsonl    append-only, line n holds the user_id of row n
+    updates.jsonl     append-only log of every applied Q-value update
+    updates.jsonl.N   rotated logs, .1 the most recent
+
+The update log is rotated once it outgrows max_log_bytes. The Q-tables are
+flushed first, so the mapped files already hold every update the rotated log
+covers. Only log_archives rotated logs are kept; replay them oldest first
+ahead of updates.jsonl to rebuild state from the retained history.
+
+BoundedUserQTable is the single-process alternative: it keeps a fixed number
+of users in memory and spills the rest to an SQLite file.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from loyalty import SEGMENTS, UserQTable
+from loyalty_snapshot import load_snapshot
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single worker only
+    fcntl = None
+
+STORE_VERSION = 1
+
+# Update log size that triggers a rotation, and rotated logs kept
+MAX_LOG_BYTES = 64 * 1024 * 1024
+LOG_ARCHIVES = 2
+
+
+class MmapUserQTable(UserQTable):
+    """UserQTable backed by a shared file, with its index synced from user_ids.jsonl"""
+
+    def __init__(self, store, num_challenges):
+        self.store = store
+        self.index = {}
+        self.num_challenges = num_challenges
+        self._ids_path = store.path("user_ids.jsonl")
+        self._values_path = store.path("user_q.f64")
+        self._ids_offset = 0
+        # Request threads sync on index misses while the writer thread allocates
+        self._sync_lock = threading.Lock()
+
+        self._map()
+        self.sync()
+
+    def _map(self):
+        row_bytes = self.num_challenges * np.dtype(np.float64).itemsize
+        rows = os.path.getsize(self._values_path) // row_bytes
+        self.values = np.memmap(
+            self._values_path,
+            dtype=np.float64,
+            mode="r+",
+            shape=(rows, self.num_challenges),
+        )
+
+    def sync(self):
+        """Pick up users allocated by other processes since the last sync"""
+        with self._sync_lock:
+            with open(self._ids_path, "rb") as f:
+                f.seek(self._ids_offset)
+                data = f.read()
+
+            complete = data[: data.rfind(b"\n") + 1]
+            for line in complete.splitlines():
+                self.index[json.loads(line)] = len(self.index)
+            self._ids_offset += len(complete)
+
+            if len(self.index) > len(self.values):
+                self._map()
+
+    def row(self, user_id):
+        if user_id not in self.index:
+            self.sync()
+        return super().row(user_id)
+
+    def find_many(self, user_ids):
+        if any(u not in self.index for u in user_ids):
+            self.sync()
+        return super().find_many(user_ids)
+
+    def ensure(self, user_id):
+        return int(self.ensure_many([user_id])[0])
+
+    def ensure_many(self, user_ids):
+        missing = [u for u in dict.fromkeys(user_ids) if u not in self.index]
+        if missing:
+            self.sync()
+            missing = [u for u in missing if u not in self.index]
+
+        if missing:
+            with self.store.lock():
+                self.sync()
+                missing = [u for u in missing if u not in self.index]
+
+                if len(self.index) + len(missing) > len(self.values):
+                    self._grow(len(self.index) + len(missing))
+
+                with open(self._ids_path, "ab") as f:
+                    f.write(b"".join(json.dumps(u).encode() + b"\n" for u in missing))
+                self.sync()
+
+        return np.fromiter(
+            (self.index[u] for u in user_ids), dtype=np.intp, count=len(user_ids)
+        )
+
+    def _grow(self, min_rows):
+        capacity = max(min_rows, 2 * len(self.values))
+        size = capacity * self.num_challenges * np.dtype(np.float64).itemsize
+
+        # Extend the file in place so existing mappings in other workers stay valid
+        self.values.flush()
+        if os.path.getsize(self._values_path) < size:
+            with open(self._values_path, "r+b") as f:
+                f.truncate(size)
+        self._map()
+
+
+class BoundedUserQTable(UserQTable):
+    def __init__(
+        self,
+        num_challenges,
+        capacity=100_000,
+        ttl=None,
+        spill_path=None,
+        clock=time.monotonic,
+    ):
+        """
+        UserQTable that holds at most `capacity` users in memory.
+
+        The least recently used users, and users idle for longer than ttl
+        seconds, are evicted. Evicted users with non-zero Q-values are spilled
+        to spill_path and paged back in on their next update; without a spill
+        path they are forgotten. Reads never allocate: unseen users are zeros.
+
+        Args:
+            num_challenges: Columns of the Q-value matrix
+            capacity: Most users kept in memory
+            ttl: Seconds without access after which a user is evicted
+            spill_path: SQLite file for evicted users, None to drop them
+            clock: Time source for ttl
+        """
+        super().__init__(num_challenges, initial_capacity=min(capacity, 1024))
+        self.capacity = capacity
+        self.ttl = ttl
+        self._clock = clock
+        self._allocation_lock = threading.RLock()
+
+        # Resident user_id -> last access time, least recently used first
+        self._recency = OrderedDict()
+        self._free_rows = []
+        self._rows_used = 0
+
+        self._spill = None
+        if spill_path is not None:
+            # One connection shared by all threads, serialized by the lock
+            self._spill = sqlite3.connect(
+                spill_path, isolation_level=None, check_same_thread=False
+            )
+            self._spill.execute("PRAGMA journal_mode=WAL")
+            self._spill.execute("PRAGMA synchronous=NORMAL")
+            self._spill.execute(
+                "CREATE TABLE IF NOT EXISTS spill (user_id TEXT PRIMARY KEY, q BLOB)"
+            )
+
+    def __len__(self):
+        return len(self.index) + self._spilled_count()
+
+    def __contains__(self, user_id):
+        return user_id in self.index or self._spilled_row(user_id) is not None
+
+    def __iter__(self):
+        yield from list(self.index)
+        if self._spill is not None:
+            with self._allocation_lock:
+                keys = self._spill.execute("SELECT user_id FROM spill").fetchall()
+            for (key,) in keys:
+                yield json.loads(key)
+
+    def row(self, user_id):
+        """Return a copy of the Q-value row of a known user, or None"""
+        with self._allocation_lock:
+            idx = self.index.get(user_id)
+            if idx is not None:
+                self._touch(user_id)
+                return self.values[idx].copy()
+            return self._spilled_row(user_id)
+
+    def find_many(self, user_ids):
+        with self._allocation_lock:
+            return super().find_many(user_ids)
+
+    def values_of(self, user_ids):
+        with self._allocation_lock:
+            values = np.zeros((len(user_ids), self.values.shape[1]))
+            for i, user_id in enumerate(user_ids):
+                idx = self.index.get(user_id)
+                if idx is not None:
+                    self._touch(user_id)
+                    values[i] = self.values[idx]
+                else:
+                    spilled = self._spilled_row(user_id)
+                    if spilled is not None:
+                        values[i] = spilled
+            return values
+
+    def ensure(self, user_id):
+        return int(self.ensure_many([user_id])[0])
+
+    def ensure_many(self, user_ids):
+        """
+        Return row indices for a sequence of users, allocating (or paging in)
+        the ones not in memory. Users of the same call are never evicted by it,
+        so the table may exceed its capacity while one batch is larger.
+        """
+        with self._allocation_lock:
+            pinned = set(user_ids)
+            self._expire(pinned)
+            # Shrink back to capacity after an earlier batch larger than it
+            self._evict_lru(self.capacity, pinned)
+
+            rows = np.empty(len(user_ids), dtype=np.intp)
+            for i, user_id in enumerate(user_ids):
+                idx = self.index.get(user_id)
+                if idx is None:
+                    idx = self._allocate(user_id, pinned)
+                self._touch(user_id)
+                rows[i] = idx
+            return rows
+
+    def _touch(self, user_id):
+        self._recency[user_id] = self._clock()
+        self._recency.move_to_end(user_id)
+
+    def _allocate(self, user_id, pinned):
+        self._evict_lru(self.capacity - 1, pinned)
+
+        if self._free_rows:
+            idx = self._free_rows.pop()
+        else:
+            idx = self._rows_used
+            self._rows_used += 1
+            if idx == len(self.values):
+                self._grow(idx + 1)
+
+        spilled = self._spilled_row(user_id)
+        if spilled is not None:
+            self.values[idx] = spilled
+            self._spill.execute(
+                "DELETE FROM spill WHERE user_id = ?", (json.dumps(user_id),)
+            )
+        else:
+            self.values[idx] = 0
+
+        self.index[user_id] = idx
+        return idx
+
+    def _evict_lru(self, max_users, pinned):
+        while len(self.index) > max_users:
+            victim = next((u for u in self._recency if u not in pinned), None)
+            if victim is None:
+                break
+            self._evict(victim)
+
+    def _expire(self, pinned):
+        if self.ttl is None:
+            return
+        cutoff = self._clock() - self.ttl
+        expired = []
+        for user_id, last_used in self._recency.items():
+            if last_used >= cutoff:
+                break
+            if user_id not in pinned:
+                expired.append(user_id)
+        for user_id in expired:
+            self._evict(user_id)
+
+    def _evict(self, user_id):
+        idx = self.index.pop(user_id)
+        del self._recency[user_id]
+        if self._spill is not None and self.values[idx].any():
+            self._spill.execute(
+                "INSERT OR REPLACE INTO spill VALUES (?, ?)",
+                (json.dumps(user_id), self.values[idx].tobytes()),
+            )
+        self._free_rows.append(idx)
+
+    def _spilled_row(self, user_id):
+        if self._spill is None:
+            return None
+        with self._allocation_lock:
+            found = self._spill.execute(
+                "SELECT q FROM spill WHERE user_id = ?", (json.dumps(user_id),)
+            ).fetchone()
+        if found is None:
+            return None
+        return np.frombuffer(found[0], dtype=np.float64).copy()
+
+    def _spilled_count(self):
+        if self._spill is None:
+            return 0
+        with self._allocation_lock:
+            return self._spill.execute("SELECT COUNT(*) FROM spill").fetchone()[0]
+
+
+class QTableStore:
+    def __init__(
+        self,
+        directory,
+        recommendation_system,
+        initial_capacity=1024,
+        snapshot_path=None,
+        max_log_bytes=MAX_LOG_BYTES,
+        log_archives=LOG_ARCHIVES,
+    ):
+        """
+        Open (or create) a store and attach it to a recommendation system.
+
+        A new store is seeded with the system's current Q-values, users and
+        bandit statistics, so priors set in the constructor are persisted. An
+        existing store replaces them.
+
+        Args:
+            directory: Store directory, created if missing
+            recommendation_system: ChallengeRecommendationSystem to back
+            initial_capacity: User rows to preallocate in a new store
+            snapshot_path: Snapshot loaded into the system before seeding a
+                new store; ignored when the store already exists
+            max_log_bytes: Size of updates.jsonl that triggers rotate_log,
+                None to never rotate
+            log_archives: Rotated update logs kept, older ones are deleted
+        """
+        self.directory = directory
+        self.max_log_bytes = max_log_bytes
+        self.log_archives = log_archives
+        os.makedirs(directory, exist_ok=True)
+
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = open(self.path(".lock"), "a+")
+
+        challenge_names = recommendation_system.challenge_names
+        num_challenges = len(challenge_names)
+
+        with self.lock():
+            # Checked under the lock: only the first worker seeds a new store
+            if not os.path.exists(self.path("meta.json")):
+                if snapshot_path is not None:
+                    load_snapshot(snapshot_path, recommendation_system, mmap=False)
+                self._create(recommendation_system, initial_capacity)
+            # Stores created before the bandit policies get empty statistics
+            for name, dtype in (
+                ("pull_counts.i64", np.int64),
+                ("reward_sums.f64", np.float64),
+            ):
+                if not os.path.exists(self.path(name)):
+                    np.zeros((len(SEGMENTS), num_challenges), dtype=dtype).tofile(
+                        self.path(name)
+                    )
+
+        with open(self.path("meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != STORE_VERSION:
+            raise ValueError(f"Unsupported Q-table store version {meta['version']}")
+        if meta["challenges"] != challenge_names or meta["segments"] != SEGMENTS:
+            raise ValueError(
+                f"Q-table store {directory} was built for a different challenge catalog"
+            )
+
+        recommendation_system.global_q = self._memmap(
+            "global_q.f64", np.float64, (num_challenges,)
+        )
+        recommendation_system.segment_q = self._memmap(
+            "segment_q.f64", np.float64, (len(SEGMENTS), num_challenges)
+        )
+        recommendation_system.segments_seen = self._memmap(
+            "segments_seen.u8", np.bool_, (len(SEGMENTS),)
+        )
+        recommendation_system.q_versions = self._memmap(
+            "q_versions.i64", np.int64, (1 + len(SEGMENTS),)
+        )
+        recommendation_system.pull_counts = self._memmap(
+            "pull_counts.i64", np.int64, (len(SEGMENTS), num_challenges)
+        )
+        recommendation_system.reward_sums = self._memmap(
+            "reward_sums.f64", np.float64, (len(SEGMENTS), num_challenges)
+        )
+        recommendation_system.user_q = MmapUserQTable(self, num_challenges)
+        recommendation_system.update_log = self
+        self.recommendation_system = recommendation_system
+
+        self._log = None
+        self._open_log()
+
+    def _open_log(self):
+        if self._log is not None:
+            self._log.close()
+        # Unbuffered O_APPEND writes keep records from different workers whole
+        self._log = open(self.path("updates.jsonl"), "ab", buffering=0)
+        self._log_inode = os.fstat(self._log.fileno()).st_ino
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _memmap(self, name, dtype, shape):
+        return np.memmap(self.path(name), dtype=dtype, mode="r+", shape=shape)
+
+    def _create(self, recommendation_system, initial_capacity):
+        num_challenges = len(recommendation_system.challenge_names)
+        user_q = recommendation_system.user_q
+        user_ids = list(user_q)
+
+        np.asarray(recommendation_system.global_q, dtype=np.float64).tofile(
+            self.path("global_q.f64")
+        )
+        np.asarray(recommendation_system.segment_q, dtype=np.float64).tofile(
+            self.path("segment_q.f64")
+        )
+        np.asarray(recommendation_system.segments_seen, dtype=np.bool_).tofile(
+            self.path("segments_seen.u8")
+        )
+        np.asarray(recommendation_system.q_versions, dtype=np.int64).tofile(
+            self.path("q_versions.i64")
+        )
+        np.asarray(recommendation_system.pull_counts, dtype=np.int64).tofile(
+            self.path("pull_counts.i64")
+        )
+        np.asarray(recommendation_system.reward_sums, dtype=np.float64).tofile(
+            self.path("reward_sums.f64")
+        )
+
+        user_values = np.zeros(
+            (max(1, initial_capacity, len(user_ids)), num_challenges)
+        )
+        user_values[: len(user_ids)] = user_q.values_of(user_ids)
+        user_values.tofile(self.path("user_q.f64"))
+        with open(self.path("user_ids.jsonl"), "wb") as f:
+            f.write(b"".join(json.dumps(u).encode() + b"\n" for u in user_ids))
+
+        # meta.json is written last: its presence marks a complete store
+        with open(self.path("meta.json"), "w") as f:
+            json.dump(
+                {
+                    "version": STORE_VERSION,
+                    "challenges": recommendation_system.challenge_names,
+                    "segments": SEGMENTS,
+                },
+                f,
+            )
+
+    @contextmanager
+    def lock(self):
+        """Exclusive lock across threads and worker processes, re-entrant"""
+        with self._thread_lock:
+            self._lock_depth += 1
+            if self._lock_depth == 1 and fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def record(self, user_ids, segments, challenges, rewards):
+        """
+        Append Q-value updates to updates.jsonl, rotating it first once it
+        has outgrown max_log_bytes.
+        """
+        lines = [
+            json.dumps(
+                {
+                    "user_id": user_id,
+                    "segment": segment,
+                    "challenge": challenge,
+                    "reward": float(reward),
+                }
+            )
+            + "\n"
+            for user_id, segment, challenge, reward in zip(
+                user_ids, segments, challenges, rewards
+            )
+        ]
+        with self.lock():
+            # Another worker may have rotated the log since this one opened it
+            if os.stat(self.path("updates.jsonl")).st_ino != self._log_inode:
+                self._open_log()
+
+            # Rotate before writing: every event logged so far has been
+            # applied, so the flush in rotate_log covers the whole rotated log
+            if (
+                self.max_log_bytes is not None
+                and os.fstat(self._log.fileno()).st_size > self.max_log_bytes
+            ):
+                self.rotate_log()
+
+            self._log.write("".join(lines).encode())
+
+    def rotate_log(self):
+        """
+        Flush the Q-tables, then move updates.jsonl to updates.jsonl.1 and
+        start a new log. Rotated logs beyond log_archives are deleted.
+        """
+        with self.lock():
+            self.flush()
+
+            log_path = self.path("updates.jsonl")
+            for n in range(self.log_archives, 0, -1):
+                older = f"{log_path}.{n}"
+                if not os.path.exists(older):
+                    continue
+                if n == self.log_archives:
+                    os.remove(older)
+                else:
+                    os.replace(older, f"{log_path}.{n + 1}")
+            if self.log_archives > 0:
+                os.replace(log_path, f"{log_path}.1")
+            else:
+                os.remove(log_path)
+            self._open_log()
+
+    def flush(self):
+        """Flush the attached system's mapped Q-tables to disk"""
+        system = self.recommendation_system
+        for table in (
+            system.global_q,
+            system.segment_q,
+            system.segments_seen,
+            system.q_versions,
+            system.pull_counts,
+            system.reward_sums,
+            system.user_q.values,
+        ):
+            table.flush()
@@ -0,0 +1,134 @@
+"""
+Parallel Monte Carlo sweeps of the loyalty simulation for policy tuning.
+
+Every grid point and replicate runs in its own process with an independent
+RNG stream spawned from one root SeedSequence, so a sweep is reproducible
+from a single seed regardless of how tasks are scheduled across workers.
+"""
+
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from loyalty import (
+    analyze_results_with_inactivity,
+    run_challenge_simulation_vectorized,
+)
+
+SWEEP_PARAMETERS = ["exploration_rate", "learning_rate", "num_users"]
+
+
+def run_sweep_point(task):
+    """
+    Run one seeded simulation and reduce it to scalar metrics.
+
+    Args:
+        task: Dict with exploration_rate, learning_rate, num_users,
+            num_iterations, replicate and seed (a SeedSequence)
+
+    Returns:
+        dict: The task parameters plus aggregated metrics
+    """
+    recommendation_system, users, results = run_challenge_simulation_vectorized(
+        num_iterations=task["num_iterations"],
+        num_users=task["num_users"],
+        exploration_rate=task["exploration_rate"],
+        learning_rate=task["learning_rate"],
+        seed=task["seed"],
+    )
+    metrics = analyze_results_with_inactivity(
+        recommendation_system, users, results, verbose=False
+    )
+
+    return {
+        "exploration_rate": task["exploration_rate"],
+        "learning_rate": task["learning_rate"],
+        "num_users": task["num_users"],
+        "replicate": task["replicate"],
+        "mean_reward": results["reward"].mean(),
+        "completion_rate": results["completed"].mean(),
+        "overall_engagement": metrics.get("overall_engagement", 0.0),
+        "purchase_growth": metrics["purchase_growth"],
+        "review_growth": metrics["review_growth"],
+        "avg_review_length": metrics.get("avg_review_length", 0.0),
+        "never_completed": (users["completed_challenges"] == 0).mean(),
+    }
+
+
+def run_policy_sweep(
+    exploration_rates,
+    learning_rates=(0.1,),
+    population_sizes=(1000,),
+    num_iterations=30,
+    replicates=1,
+    seed=None,
+    max_workers=None,
+):
+    """
+    Fan simulations out over a parameter grid on a process pool.
+
+    Args:
+        exploration_rates: Exploration rates to try
+        learning_rates: Learning rates to try
+        population_sizes: Simulated user counts to try
+        num_iterations: Iterations per simulation
+        replicates: Independent runs per grid point
+        seed: Root seed of the sweep
+        max_workers: Process count, defaults to the number of CPUs
+
+    Returns:
+        pd.DataFrame: One row of metrics per simulation
+    """
+    grid = list(
+        itertools.product(
+            exploration_rates, learning_rates, population_sizes, range(replicates)
+        )
+    )
+    seeds = np.random.SeedSequence(seed).spawn(len(grid))
+
+    tasks = [
+        {
+            "exploration_rate": exploration_rate,
+            "learning_rate": learning_rate,
+            "num_users": num_users,
+            "num_iterations": num_iterations,
+            "replicate": replicate,
+            "seed": task_seed,
+        }
+        for (exploration_rate, learning_rate, num_users, replicate), task_seed in zip(
+            grid, seeds
+        )
+    ]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        rows = list(pool.map(run_sweep_point, tasks))
+
+    return pd.DataFrame(rows)
+
+
+def summarize_sweep(sweep_results):
+    """Mean and standard deviation of every metric per grid point"""
+    metrics = sweep_results.drop(columns=SWEEP_PARAMETERS + ["replicate"])
+    return (
+        sweep_results[SWEEP_PARAMETERS]
+        .join(metrics)
+        .groupby(SWEEP_PARAMETERS)
+        .agg(["mean", "std"])
+        .sort_values(("mean_reward", "mean"), ascending=False)
+    )
+
+
+if __name__ == "__main__":
+    sweep_results = run_policy_sweep(
+        exploration_rates=[0.05, 0.1, 0.2, 0.3],
+        learning_rates=[0.05, 0.1, 0.2],
+        population_sizes=[1000, 10000],
+        num_iterations=30,
+        replicates=4,
+        seed=42,
+    )
+
+    print("=== POLICY SWEEP (best mean reward first) ===")
+    print(summarize_sweep(sweep_results)[["mean_reward", "overall_engagement"]])
@@ -0,0 +1,641 @@
+import os
+import hashlib
+import shutil
+import time
+import numpy as np
+import pandas as pd
+import pickle
+from PIL import Image
+import matplotlib.pyplot as plt
+import tensorflow as tf
+from tensorflow.keras.preprocessing import image
+from tensorflow.keras.applications.resnet50 import ResNet50, preprocess_input
+from tensorflow.keras.models import Model
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from visual_embedding_store import EmbeddingStore
+from visual_search_index import IVFIndex, build_index
+
+# Indexing pipeline defaults: images per predict call, image loader threads,
+# and batches loaded ahead of the one being predicted
+BATCH_SIZE = 32
+NUM_LOADERS = 4
+PREFETCH_BATCHES = 2
+
+# Saved features live in a versioned subdirectory named by this file, so the
+# embeddings, metadata and search index are always switched together
+CURRENT_FEATURES_FILE = 'CURRENT'
+
+class ProductVisualSearch:
+    def __init__(self, images_directory, product_data_path, batch_size=BATCH_SIZE,
+                 num_loaders=NUM_LOADERS, prefetch_batches=PREFETCH_BATCHES,
+                 embedding_encoding='float32'):
+        """
+        Initialize the visual search system
+        
+        Args:
+            images_directory: Path to directory containing product images
+            product_data_path: Path to CSV file containing product metadata
+            batch_size: Images per model.predict call while indexing
+            num_loaders: Threads decoding and resizing images while indexing
+            prefetch_batches: Batches loaded ahead of the one being predicted
+            embedding_encoding: How saved features are stored: 'float32',
+                'float16' or 'int8' (2x and 4x smaller, slightly lossy)
+        """
+        self.images_directory = images_directory
+        self.batch_size = batch_size
+        self.num_loaders = num_loaders
+        self.prefetch_batches = prefetch_batches
+        self.embedding_encoding = embedding_encoding
+        
+        # Load product metadata
+        self.product_data = pd.read_csv(product_data_path)
+        print(f"Loaded product data with {len(self.product_data)} entries")
+        
+        # Load pre-trained ResNet50 model without the top classification layer
+        base_model = ResNet50(weights='imagenet', include_top=False, pooling='avg')
+        self.model = Model(inputs=base_model.input, outputs=base_model.output)
+        
+        # Set parameters
+        self.img_size = (224, 224)  # ResNet50 expected input size
+        
+        # Storage for image features, paths, and ASINs
+        self.features = []
+        self.image_paths = []
+        self.asins = []
+        # (mtime_ns, size, content hash) per indexed image path
+        self.image_signatures = {}
+        # Same signatures of images that failed to load, retried once changed
+        self.failed_images = {}
+        
+        # Scan and index all images in the directory
+        self._index_images()
+        self.build_index()
+    
+    def _extract_asin(self, filename):
+        """Extract ASIN from filename"""
+        # Assuming filename format is ASIN.jpg (e.g., B0DQXGCPFJ.jpg)
+        asin = os.path.splitext(filename)[0]
+        # Verify it looks like an ASIN (typically 10 characters, alphanumeric)
+        if re.match(r'^[A-Z0-9]{10}$', asin):
+            return asin
+        return None
+    
+    def _scan_images(self, images_directory):
+        """
+        List the product images in a directory
+        
+        Returns:
+            List of (img_path, asin) tuples
+        """
+        valid_extensions = ('.jpg', '.jpeg', '.png')
+        candidates = []
+        
+        for filename in os.listdir(images_directory):
+            if filename.lower().endswith(valid_extensions):
+                img_path = os.path.join(images_directory, filename)
+                
+                # Extract ASIN from filename
+                asin = self._extract_asin(filename)
+                if not asin:
+                    print(f"Skipping {filename}: Could not extract valid ASIN")
+                    continue
+                
+                candidates.append((img_path, asin))
+        
+        return candidates
+    
+    def _index_images(self):
+        """Scan the images directory and extract features from all images"""
+        print(f"Indexing images from {self.images_directory}...")
+        
+        candidates = self._scan_images(self.images_directory)
+        
+        feature_batches = []
+        batches = self._extract_features_batches(candidates, self.failed_images)
+        for features, img_paths, asins, signatures in batches:
+            # Store features, paths, ASINs and file signatures
+            feature_batches.append(features)
+            self.image_paths.extend(img_paths)
+            self.asins.extend(asins)
+            self.image_signatures.update(zip(img_paths, signatures))
+            print(f"Processed {len(self.image_paths)} images")
+        
+        # Stack the batches into one numpy array for faster processing
+        self.features = np.concatenate(feature_batches) if feature_batches else np.array([])
+        print(f"Indexed {len(self.features)} images successfully")
+    
+    def _load_image(self, img_path):
+        """Load and resize an image to the model's input size, as a float array"""
+        img = image.load_img(img_path, target_size=self.img_size)
+        return image.img_to_array(img)
+    
+    def _file_signature(self, img_path):
+        """(mtime_ns, size, content hash) of an image file"""
+        stat = os.stat(img_path)
+        with open(img_path, 'rb') as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        return (stat.st_mtime_ns, stat.st_size, digest)
+    
+    def _load_for_index(self, img_path):
+        return self._load_image(img_path), self._file_signature(img_path)
+    
+    def _is_unchanged(self, img_path, signatures=None):
+        """Whether an image file still has the content its recorded signature has"""
+        if signatures is None:
+            signatures = self.image_signatures
+        recorded = signatures.get(img_path)
+        if recorded is None or not os.path.exists(img_path):
+            return False
+        
+        # Same mtime and size is trusted, otherwise compare content hashes
+        stat = os.stat(img_path)
+        if (stat.st_mtime_ns, stat.st_size) == tuple(recorded[:2]):
+            return True
+        signature = self._file_signature(img_path)
+        if signature[2] != recorded[2]:
+            return False
+        signatures[img_path] = signature
+        return True
+    
+    def _iter_loaded_images(self, candidates):
+        """
+        Load images on a thread pool, at most prefetch_batches batches ahead
+        
+        Args:
+            candidates: List of (img_path, asin) tuples
+            
+        Yields:
+            (img_path, asin, (img_array, signature), error) tuples in input order
+        """
+        max_pending = self.batch_size * (self.prefetch_batches + 1)
+        remaining = iter(candidates)
+        pending = deque()
+        
+        with ThreadPoolExecutor(max_workers=self.num_loaders) as executor:
+            def submit_next():
+                candidate = next(remaining, None)
+                if candidate is not None:
+                    pending.append((*candidate, executor.submit(self._load_for_index, candidate[0])))
+            
+            for _ in range(max_pending):
+                submit_next()
+            
+            while pending:
+                img_path, asin, future = pending.popleft()
+                submit_next()
+                try:
+                    yield img_path, asin, future.result(), None
+                except Exception as e:
+                    yield img_path, asin, None, e
+    
+    def _extract_features_batches(self, candidates, failures=None):
+        """
+        Extract features of many images, batch_size images per predict call
+        
+        Args:
+            candidates: List of (img_path, asin) tuples
+            failures: Dict that receives the file signature of each image
+                that fails to load
+            
+        Yields:
+            (features, img_paths, asins, signatures) per batch, skipping
+            unreadable images
+        """
+        batch = []
+        for img_path, asin, loaded, error in self._iter_loaded_images(candidates):
+            if error is not None:
+                print(f"Error processing {os.path.basename(img_path)}: {error}")
+                if failures is not None:
+                    try:
+                        failures[img_path] = self._file_signature(img_path)
+                    except OSError:
+                        # Gone or unreadable: nothing to compare against next time
+                        failures.pop(img_path, None)
+                continue
+            
+            batch.append((img_path, asin, *loaded))
+            if len(batch) == self.batch_size:
+                yield self._predict_batch(batch)
+                batch = []
+        
+        if batch:
+            yield self._predict_batch(batch)
+    
+    def _predict_batch(self, batch):
+        img_paths, asins, img_arrays, signatures = zip(*batch)
+        features = self._extract_features_array(np.stack(img_arrays))
+        return features, list(img_paths), list(asins), list(signatures)
+    
+    def _extract_features_array(self, img_arrays):
+        """
+        Extract normalized features from a batch of loaded images
+        
+        Args:
+            img_arrays: Array of images, shape (batch, height, width, 3)
+            
+        Returns:
+            Feature vectors, one row per image
+        """
+        img_arrays = preprocess_input(img_arrays)
+        
+        # Extract features - with ResNet50 and avg pooling, features are already flattened
+        features = self.model.predict(img_arrays, batch_size=len(img_arrays), verbose=0)
+        
+        # Normalize the features
+        return features / np.linalg.norm(features, axis=1, keepdims=True)
+    
+    def _extract_features(self, img_path):
+        """
+        Extract features from a single image using the pre-trained model
+        
+        Args:
+            img_path: Path to the image file
+            
+        Returns:
+            Feature vector for the image
+        """
+        # Load and preprocess image
+        img_array = np.expand_dims(self._load_image(img_path), axis=0)
+        
+        return self._extract_features_array(img_array)[0]
+    
+    def get_product_info(self, asin):
+        """Get product metadata for a given ASIN"""
+        product = self.product_data[self.product_data['asin'] == asin]
+        if len(product) == 0:
+            return {
+                'title': f"Product {asin}",
+                'price': "N/A",
+                'rating': "N/A",
+                'category': "N/A",
+                'asin': asin
+            }
+        
+        # Return first matching product
+        product = product.iloc[0]
+        return {
+            'title': product.get('title', f"Product {asin}"),
+            'price': product.get('price', "N/A"),
+            'rating': product.get('rating', "N/A"),
+            'category': product.get('category', "N/A"),
+            'asin': asin
+        }
+    
+    def update_index(self, images_directory=None, save_directory=None):
+        """
+        Bring the index up to date with the images directory
+        
+        Only new images and images whose content changed are embedded, and
+        deleted images are dropped. Images indexed without a recorded file
+        signature count as changed. Images that failed to load are retried
+        only once their file changes.
+        
+        Args:
+            images_directory: Directory to sync with, the indexed one by default
+            save_directory: Saved model directory whose features to update in place
+            
+        Returns:
+            Dict with the number of added, updated, removed and unchanged images
+        """
+        images_directory = images_directory or self.images_directory
+        if images_directory is None:
+            raise ValueError("No images directory to update the index from")
+        self.images_directory = images_directory
+        
+        candidates = self._scan_images(images_directory)
+        current_paths = {img_path for img_path, _ in candidates}
+        
+        kept_rows = [row for row, img_path in enumerate(self.image_paths)
+                     if img_path in current_paths and self._is_unchanged(img_path)]
+        kept_paths = {self.image_paths[row] for row in kept_rows}
+        failed_images = {img_path: self.failed_images[img_path]
+                         for img_path in list(self.failed_images)
+                         if img_path in current_paths
+                         and self._is_unchanged(img_path, self.failed_images)}
+        to_embed = [(img_path, asin) for img_path, asin in candidates
+                    if img_path not in kept_paths and img_path not in failed_images]
+        
+        indexed_paths = set(self.image_paths)
+        counts = {
+            'added': sum(img_path not in indexed_paths for img_path, _ in to_embed),
+            'updated': sum(img_path in indexed_paths for img_path, _ in to_embed),
+            'removed': len(indexed_paths - current_paths),
+            'unchanged': len(kept_rows),
+        }
+        if (not to_embed and len(kept_rows) == len(self.image_paths)
+                and len(failed_images) == len(self.failed_images)):
+            print("Index is up to date")
+            return counts
+        
+        print(f"Updating index: {counts}")
+        feature_batches = [self.features[kept_rows]] if kept_rows else []
+        image_paths = [self.image_paths[row] for row in kept_rows]
+        asins = [self.asins[row] for row in kept_rows]
+        image_signatures = {img_path: self.image_signatures[img_path] for img_path in image_paths}
+        
+        batches = self._extract_features_batches(to_embed, failed_images)
+        for features, img_paths, batch_asins, signatures in batches:
+            feature_batches.append(features)
+            image_paths.extend(img_paths)
+            asins.extend(batch_asins)
+            image_signatures.update(zip(img_paths, signatures))
+        
+        self.features = np.concatenate(feature_batches) if feature_batches else np.array([])
+        self.image_paths = image_paths
+        self.asins = asins
+        self.image_signatures = image_signatures
+        self.failed_images = failed_images
+        
+        # Kept images keep their old rows, embedded ones are new to the index
+        old_rows = np.full(len(self.features), -1)
+        old_rows[:len(kept_rows)] = kept_rows
+        if len(self.features) and hasattr(self.index, 'update'):
+            self.index = self.index.update(self.features, old_rows)
+        else:
+            self.build_index()
+        
+        if save_directory is not None:
+            self.save_features(save_directory)
+        print(f"Indexed {len(self.features)} images successfully")
+        return counts
+    
+    def build_index(self, kind=None, **params):
+        """
+        Build the nearest-neighbour index used by search
+        
+        Args:
+            kind: 'exact' or 'ivf'; by default ivf for large catalogs
+            **params: IVFIndex parameters, e.g. n_lists and n_probe
+        """
+        self.index = build_index(self.features, kind, **params)
+        print(f"Built {type(self.index).__name__} over {len(self.features)} images")
+    
+    def search(self, query_img_path, top_k=5, n_probe=None):
+        """
+        Search for similar images to the query image
+        
+        Args:
+            query_img_path: Path to the query image
+            top_k: Number of top results to return
+            n_probe: Clusters an IVF index scans, higher is slower with better recall
+            
+        Returns:
+            List of (image_path, asin, product_info, similarity_score) tuples for top matches
+        """
+        # Extract features from query image
+        query_features = self._extract_features(query_img_path)
+        
+        # Get indices and cosine similarities of the top-k most similar images
+        top_indices, similarities = self.index.search(query_features, top_k, n_probe=n_probe)
+        
+        # Create result list with image paths, ASINs, product info, and similarity scores
+        results = []
+        for i, similarity in zip(top_indices, similarities):
+            asin = self.asins[i]
+            product_info = self.get_product_info(asin)
+            results.append((self.image_paths[i], asin, product_info, similarity))
+        
+        return results
+    
+    def visualize_results(self, query_img_path, results):
+        """
+        Visualize search results with product information
+        
+        Args:
+            query_img_path: Path to the query image
+            results: List of (image_path, asin, product_info, similarity_score) tuples
+        """
+        n_results = len(results)
+        plt.figure(figsize=(18, 4 + n_results * 4))
+        
+        # Extract ASIN from query image if available
+        query_asin = self._extract_asin(os.path.basename(query_img_path))
+        query_info = None
+        if query_asin:
+            query_info = self.get_product_info(query_asin)
+        
+        # Display query image with product info if available
+        plt.subplot(n_results + 1, 1, 1)
+        query_img = Image.open(query_img_path)
+        plt.imshow(query_img)
+        
+        if query_info:
+            title = f"Query: {query_info['title'][:50]}..." if len(query_info['title']) > 50 else f"Query: {query_info['title']}"
+            subtitle = f"ASIN: {query_asin} | Price: {query_info['price']} | Rating: {query_info['rating']} | Category: {query_info['category']}"
+        else:
+            title = "Query Image"
+            subtitle = os.path.basename(query_img_path)
+            
+        plt.title(title, fontsize=14)
+        plt.xlabel(subtitle, fontsize=10)
+        plt.xticks([])
+        plt.yticks([])
+        
+        # Display result images with product info
+        for i, (img_path, asin, product_info, score) in enumerate(results):
+            plt.subplot(n_results + 1, 1, i + 2)
+            result_img = Image.open(img_path)
+            plt.imshow(result_img)
+            
+            title = f"{i+1}. {product_info['title'][:50]}..." if len(product_info['title']) > 50 else f"{i+1}. {product_info['title']}"
+            subtitle = f"ASIN: {asin} | Price: {product_info['price']} | Rating: {product_info['rating']} | Similarity: {score:.4f}"
+            
+            plt.title(title, fontsize=12)
+            plt.xlabel(subtitle, fontsize=10)
+            plt.xticks([])
+            plt.yticks([])
+        
+        plt.tight_layout()
+        plt.show()
+
+    def print_results(self, results):
+        """
+        Print detailed search results
+        
+        Args:
+            results: List of (image_path, asin, product_info, similarity_score) tuples
+        """
+        print("\n===== SIMILAR PRODUCTS =====")
+        for i, (img_path, asin, product_info, score) in enumerate(results):
+            print(f"\n{i+1}. ASIN: {asin} (Similarity: {score:.4f})")
+            print(f"   Title: {product_info['title']}")
+            print(f"   Price: {product_info['price']}")
+            print(f"   Rating: {product_info['rating']}")
+            print(f"   Category: {product_info['category']}")
+            print(f"   Image: {os.path.basename(img_path)}")
+            print("   " + "-"*50)
+
+    def save_model(self, save_directory):
+        """
+        Save the trained model and indexed features
+        
+        Args:
+            save_directory: Directory path to save the model and features
+        """
+        os.makedirs(save_directory, exist_ok=True)
+        
+        # Save the feature extraction model
+        model_path = os.path.join(save_directory, "resnet_feature_extractor.h5")
+        self.model.save(model_path)
+        print(f"Model saved to {model_path}")
+        
+        self.save_features(save_directory)
+    
+    def save_features(self, save_directory):
+        """
+        Save the indexed features and search index as a new version of them
+        
+        The embeddings, metadata and index are written to a new subdirectory,
+        then the CURRENT file is switched to it in one rename, so a loader
+        never pairs files of different saves. The previous version is kept
+        for loaders that read CURRENT just before the switch.
+        
+        Args:
+            save_directory: Directory path to save the features to
+        """
+        os.makedirs(save_directory, exist_ok=True)
+        previous = self._current_features_version(save_directory)
+        version = f"features-{time.time_ns()}"
+        features_directory = os.path.join(save_directory, version)
+        os.makedirs(features_directory)
+        
+        # Save the features as raw .npy files that workers memory-map
+        store = self.features
+        if not isinstance(store, EmbeddingStore) or store.encoding != self.embedding_encoding:
+            store = EmbeddingStore.from_features(self.features, self.embedding_encoding)
+        store.save(features_directory)
+        print(f"{store.encoding} embeddings saved to {features_directory}")
+        
+        # Save the image paths, ASINs and file signatures
+        features_data = {
+            'image_paths': self.image_paths,
+            'asins': self.asins,
+            'image_signatures': self.image_signatures,
+            'failed_images': self.failed_images,
+            'images_directory': self.images_directory,
+            'embedding_encoding': self.embedding_encoding
+        }
+        features_path = os.path.join(features_directory, "indexed_features.pkl")
+        with open(features_path, 'wb') as f:
+            pickle.dump(features_data, f)
+        print(f"Indexed features saved to {features_path}")
+        
+        # Save the IVF index, an exact index is rebuilt from the features on load
+        if isinstance(self.index, IVFIndex):
+            index_path = os.path.join(features_directory, "ann_index.npz")
+            with open(index_path, 'wb') as f:
+                self.index.save(f)
+            print(f"Search index saved to {index_path}")
+        
+        # Switch all three files at once
+        current_path = os.path.join(save_directory, CURRENT_FEATURES_FILE)
+        with open(current_path + '.tmp', 'w') as f:
+            f.write(version)
+        os.replace(current_path + '.tmp', current_path)
+        
+        # Drop versions older than the previous one; processes still mapping
+        # their files keep reading them
+        for name in os.listdir(save_directory):
+            if name.startswith('features-') and name not in (version, previous):
+                shutil.rmtree(os.path.join(save_directory, name), ignore_errors=True)
+    
+    @staticmethod
+    def _current_features_version(save_directory):
+        """Subdirectory name of the current saved features, None if unversioned"""
+        current_path = os.path.join(save_directory, CURRENT_FEATURES_FILE)
+        if not os.path.exists(current_path):
+            return None
+        with open(current_path) as f:
+            return f.read().strip()
+    
+    @classmethod
+    def load_model(cls, save_directory, product_data_path, mmap=True):
+        """
+        Load a previously saved model and indexed features
+        
+        Args:
+            save_directory: Directory path where model and features were saved
+            product_data_path: Path to CSV file containing product metadata
+            mmap: Map the saved embeddings read-only, shared by all processes,
+                instead of reading them into memory
+            
+        Returns:
+            ProductVisualSearch instance with loaded model and features
+        """
+        # Create an instance without initializing
+        instance = cls.__new__(cls)
+        
+        # Load product data
+        instance.product_data = pd.read_csv(product_data_path)
+        instance.img_size = (224, 224)  # ResNet50 expected input size
+        instance.batch_size = BATCH_SIZE
+        instance.num_loaders = NUM_LOADERS
+        instance.prefetch_batches = PREFETCH_BATCHES
+        
+        # Load the model
+        model_path = os.path.join(save_directory, "resnet_feature_extractor.h5")
+        instance.model = tf.keras.models.load_model(model_path)
+        print(f"Model loaded from {model_path}")
+        
+        # Load the current version of the indexed features; saves from before
+        # versioning keep them in the save directory itself
+        version = cls._current_features_version(save_directory)
+        features_directory = os.path.join(save_directory, version) if version else save_directory
+        features_path = os.path.join(features_directory, "indexed_features.pkl")
+        with open(features_path, 'rb') as f:
+            features_data = pickle.load(f)
+        
+        # Features saved before the embedding store are inside the pickle
+        if EmbeddingStore.exists(features_directory):
+            instance.features = EmbeddingStore.open(features_directory, mmap=mmap)
+        else:
+            instance.features = features_data['features']
+        instance.embedding_encoding = features_data.get('embedding_encoding', 'float32')
+        instance.image_paths = features_data['image_paths']
+        instance.asins = features_data['asins']
+        # Features saved before incremental indexing have no file signatures
+        instance.image_signatures = features_data.get('image_signatures', {})
+        instance.failed_images = features_data.get('failed_images', {})
+        instance.images_directory = features_data.get('images_directory')
+        
+        print(f"Loaded {len(instance.features)} indexed features")
+        
+        # Load the saved IVF index if it covers the same images, else build one
+        index_path = os.path.join(features_directory, "ann_index.npz")
+        if os.path.exists(index_path):
+            instance.index = IVFIndex.load(index_path, instance.features)
+            if len(instance.index) != len(instance.features):
+                instance.build_index()
+        else:
+            instance.build_index()
+        return instance
+
+
+# Example usage for saving the model
+if __name__ == "__main__":
+    # Directory containing all product images
+    image_directory = "downloaded_images"
+    
+    # Path to CSV file with product metadata
+    product_data_path = "data_scrape\\merged_data.csv"
+    
+    # Directory to save the model
+    save_directory = "visual_search_model"
+    
+    # Initialize and train visual search system
+    search_system = ProductVisualSearch(image_directory, product_data_path)
+    
+    # Save the model and features
+    search_system.save_model(save_directory)
+    
+    # Later, you can load the model without retraining
+    loaded_system = ProductVisualSearch.load_model(save_directory, product_data_path)
+    
+    # Use the loaded model for search
+    query_image = "laptop image.jpeg"
+    results = loaded_system.search(query_image, top_k=5)
+    loaded_system.print_results(results)
+    loaded_system.visualize_results(query_image, results)
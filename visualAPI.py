@@ -21,6 +21,12 @@ UPLOAD_FOLDER = 'temp_uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 MODEL_DIRECTORY = 'visual_search_model'
 PRODUCT_DATA_PATH = 'data_scrape/merged_data.csv'
+# Search index: 'exact', 'ivf', or unset to keep the saved/automatic choice
+SEARCH_INDEX = os.environ.get('VISUAL_SEARCH_INDEX')
+# Clusters an IVF index scans per query unless a request sets n_probe
+SEARCH_N_PROBE = os.environ.get('VISUAL_SEARCH_N_PROBE')
+# Map the saved embeddings, shared by all workers, instead of reading them in
+EMBEDDINGS_MMAP = os.environ.get('VISUAL_SEARCH_MMAP', '1') != '0'
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
@@ -30,7 +36,12 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # Load the visual search model
 try:
-    visual_search = ProductVisualSearch.load_model(MODEL_DIRECTORY, PRODUCT_DATA_PATH)
+    visual_search = ProductVisualSearch.load_model(MODEL_DIRECTORY, PRODUCT_DATA_PATH,
+                                                  mmap=EMBEDDINGS_MMAP)
+    if SEARCH_INDEX:
+        visual_search.build_index(SEARCH_INDEX)
+    if SEARCH_N_PROBE and hasattr(visual_search.index, 'n_probe'):
+        visual_search.index.n_probe = int(SEARCH_N_PROBE)
     print("Visual search model loaded successfully")
 except Exception as e:
     print(f"Error loading visual search model: {e}")
@@ -64,6 +75,7 @@ def search():
     Accepts:
     - 'image': File upload
     - 'top_k': Number of results to return (optional, default=5)
+    - 'n_probe': Index clusters to scan, trading latency for recall (optional)
     
     Returns:
     - JSON with search results including product info and base64 images
@@ -80,6 +92,7 @@ def search():
         
     # Get number of results to return
     top_k = int(request.form.get('top_k', 5))
+    n_probe = request.form.get('n_probe', type=int)
     
     if file and allowed_file(file.filename):
         # Generate a unique filename to avoid conflicts
@@ -89,7 +102,7 @@ def search():
         
         try:
             # Perform the search
-            results = visual_search.search(filepath, top_k=top_k)
+            results = visual_search.search(filepath, top_k=top_k, n_probe=n_probe)
             
             # Format results for JSON response
             formatted_results = []
@@ -144,6 +157,7 @@ def search_by_base64():
     Accepts:
     - 'image_base64': Base64 encoded image string
     - 'top_k': Number of results to return (optional, default=5)
+    - 'n_probe': Index clusters to scan, trading latency for recall (optional)
     
     Returns:
     - JSON with search results including product info and base64 images
@@ -161,6 +175,7 @@ def search_by_base64():
     
     # Get number of results
     top_k = int(data.get('top_k', 5))
+    n_probe = int(data['n_probe']) if 'n_probe' in data else None
     
     try:
         # Decode base64 image
@@ -176,7 +191,7 @@ def search_by_base64():
             img.save(filepath)
         
         # Perform the search
-        results = visual_search.search(filepath, top_k=top_k)
+        results = visual_search.search(filepath, top_k=top_k, n_probe=n_probe)
         
         # Format results for JSON response (same as in /search endpoint)
         formatted_results = []
@@ -315,11 +330,5 @@ def get_product(asin):
     })
 
 if __name__ == '__main__':
-    # Create a separate file for the ProductVisualSearch class if it doesn't exist
-    with open('product_visual_search.py', 'w') as f:
-        print("Creating product_visual_search.py...")
-        # Here you would put the original ProductVisualSearch class code
-        # For brevity, it's not included here
-    
     print(f"API server starting. Model loaded with {len(visual_search.features)} indexed images.")
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+Compact, memory-mappable storage of image embeddings for visual search.
+
+Vectors are L2-normalized and stored in one of three encodings:
+    float32   4 bytes per dimension
+    float16   2 bytes per dimension
+    int8      1 byte per dimension plus one float32 scale per vector
+
+A saved store is two raw .npy files in a directory:
+    embeddings.npy         vectors x dimensions, in the store's encoding
+    embedding_scales.npy   per-vector scales, int8 only
+
+Opened with mmap, the files are mapped read-only, so every worker process
+shares one page-cache copy instead of holding its own array. Scores are
+computed in fixed-size row chunks, dequantizing only the chunk in use.
+"""
+
+import os
+
+import numpy as np
+
+ENCODINGS = ('float32', 'float16', 'int8')
+EMBEDDINGS_FILE = 'embeddings.npy'
+SCALES_FILE = 'embedding_scales.npy'
+
+# Rows dequantized at a time while scoring
+CHUNK_ROWS = 16384
+
+
+def normalize(vectors):
+    """L2-normalize vectors along the last axis, as float32"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingStore:
+    def __init__(self, vectors, scales=None):
+        """
+        Normalized vectors in a compact encoding
+
+        Args:
+            vectors: vectors x dimensions array (or memmap) of float32,
+                float16 or int8 codes
+            scales: Per-vector float32 scales of int8 codes
+        """
+        self.vectors = vectors
+        self.scales = scales
+
+    @classmethod
+    def from_features(cls, features, encoding='float32'):
+        """
+        Normalize and encode feature vectors
+
+        Args:
+            features: Feature vectors, one row per image
+            encoding: One of ENCODINGS
+
+        Returns:
+            EmbeddingStore holding the encoded vectors in memory
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding {encoding!r}, expected one of {ENCODINGS}")
+
+        vectors = normalize(features)
+        if encoding == 'float32':
+            return cls(vectors)
+        if encoding == 'float16':
+            return cls(vectors.astype(np.float16))
+
+        # Symmetric per-vector quantization onto [-127, 127]
+        scales = np.abs(vectors).max(axis=1) / 127 if len(vectors) else np.empty(0)
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return cls(codes, scales)
+
+    @property
+    def encoding(self):
+        return self.vectors.dtype.name
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _decode(self, vectors, scales):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if scales is not None:
+            vectors = vectors * scales[:, None]
+        return vectors
+
+    def __getitem__(self, rows):
+        """Decoded float32 vectors of a row index, slice or index array"""
+        scales = self.scales[rows] if self.scales is not None else None
+        return self._decode(self.vectors[rows], scales)
+
+    def dot(self, query, rows=None):
+        """
+        Inner products of a query with stored vectors
+
+        Args:
+            query: Normalized query vector
+            rows: Row indices to score, all rows by default
+
+        Returns:
+            np.ndarray: Score per row
+        """
+        query = np.asarray(query, dtype=np.float32)
+        num_rows = len(self) if rows is None else len(rows)
+        scores = np.empty(num_rows, dtype=np.float32)
+
+        for start in range(0, num_rows, CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, num_rows)
+            chunk = slice(start, stop) if rows is None else rows[start:stop]
+            # Scale after the product: one multiply per row instead of per value
+            scores[start:stop] = np.asarray(self.vectors[chunk], dtype=np.float32) @ query
+            if self.scales is not None:
+                scores[start:stop] *= self.scales[chunk]
+        return scores
+
+    def save(self, directory):
+        """Write the store as raw .npy files, replacing saved ones in place"""
+        os.makedirs(directory, exist_ok=True)
+        arrays = {EMBEDDINGS_FILE: self.vectors}
+        if self.scales is not None:
+            arrays[SCALES_FILE] = self.scales
+
+        for name, array in arrays.items():
+            path = os.path.join(directory, name)
+            # Rename into place: workers mapping the old file keep reading it
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(path + '.tmp', path)
+
+        scales_path = os.path.join(directory, SCALES_FILE)
+        if self.scales is None and os.path.exists(scales_path):
+            os.remove(scales_path)
+
+    @classmethod
+    def open(cls, directory, mmap=True):
+        """
+        Open a saved store
+
+        Args:
+            directory: Directory written by save
+            mmap: Map the files read-only instead of reading them into memory
+
+        Returns:
+            EmbeddingStore over the saved vectors
+        """
+        mmap_mode = 'r' if mmap else None
+        vectors = np.load(os.path.join(directory, EMBEDDINGS_FILE), mmap_mode=mmap_mode)
+        scales = None
+        if vectors.dtype == np.int8:
+            scales = np.load(os.path.join(directory, SCALES_FILE), mmap_mode=mmap_mode)
+        return cls(vectors, scales)
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, EMBEDDINGS_FILE))
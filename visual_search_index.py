@@ -0,0 +1,279 @@
+"""
+Nearest-neighbour indexes over image feature vectors for ProductVisualSearch.
+
+Vectors are L2-normalized and held in an EmbeddingStore, so the inner product
+scores returned here equal the cosine similarity of the original features.
+Indexes score straight from the store they are built on, which may be a
+float16 or int8 store memory-mapped from disk; they keep no copy of it.
+
+ExactIndex scans every vector. IVFIndex (inverted file) clusters the vectors
+with spherical k-means and only scans the n_probe clusters whose centroids are
+closest to the query: raising n_probe trades latency for recall, and it falls
+back to an exact scan when the probed clusters hold fewer than top_k vectors.
+Any object with build(features) and search(query, top_k, n_probe) can be
+used as an index; one that also has update(features, old_rows) is updated
+in place when images are added or removed, instead of being rebuilt.
+"""
+
+import numpy as np
+
+from visual_embedding_store import EmbeddingStore, normalize
+
+# Below this many vectors an exact scan is as fast as probing an IVF index
+IVF_MIN_SIZE = 50000
+
+
+def as_store(features):
+    """Features as an EmbeddingStore, encoding plain arrays as float32"""
+    if isinstance(features, EmbeddingStore):
+        return features
+    return EmbeddingStore.from_features(features)
+
+
+def top_k_indices(scores, top_k):
+    """Indices of the top_k highest scores, best first"""
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(-scores, top_k - 1)[:top_k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class ExactIndex:
+    """Brute-force index scoring the query against every vector"""
+
+    def build(self, features):
+        self.vectors = as_store(features)
+        return self
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, query, top_k=5, n_probe=None):
+        """
+        Find the vectors most similar to a query
+
+        Args:
+            query: Feature vector of the query
+            top_k: Number of results to return
+            n_probe: Ignored, accepted for a common interface
+
+        Returns:
+            (indices, scores) of the top matches, best first
+        """
+        scores = self.vectors.dot(normalize(query))
+        top = top_k_indices(scores, top_k)
+        return top, scores[top]
+
+    def update(self, features, old_rows):
+        """Replace the indexed vectors, see IVFIndex.update"""
+        return self.build(features)
+
+
+class IVFIndex:
+    def __init__(self, n_lists=None, n_probe=8, n_iter=20, sample_size=100000, seed=0):
+        """
+        Inverted file index over spherical k-means clusters
+
+        Args:
+            n_lists: Number of clusters, 4 * sqrt(vectors) by default
+            n_probe: Clusters scanned per query unless a search overrides it
+            n_iter: k-means iterations
+            sample_size: Vectors the clusters are trained on
+            seed: Seed of the training sample and initial centroids
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _assign(vectors, centroids, chunk_size=65536):
+        """Nearest centroid per vector, in chunks to bound memory"""
+        if len(vectors) == 0:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate([
+            np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+            for start in range(0, len(vectors), chunk_size)
+        ])
+
+    def _train(self, vectors, n_lists):
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(len(vectors), max(self.sample_size, n_lists))
+        sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+
+        for _ in range(self.n_iter):
+            assignment = self._assign(sample, centroids)
+            order = np.argsort(assignment, kind='stable')
+            clusters, starts = np.unique(assignment[order], return_index=True)
+            # Empty clusters keep their previous centroid
+            centroids[clusters] = normalize(np.add.reduceat(sample[order], starts))
+
+        return centroids
+
+    def build(self, features):
+        """
+        Cluster the vectors and build the per-cluster row lists
+
+        Args:
+            features: Feature vectors or EmbeddingStore, one row per image
+
+        Returns:
+            The built index
+        """
+        self.vectors = as_store(features)
+        n_lists = self.n_lists or int(4 * np.sqrt(len(self.vectors)))
+        n_lists = max(1, min(n_lists, len(self.vectors)))
+
+        self.centroids = self._train(self.vectors, n_lists)
+        self._lay_out(self._assign(self.vectors, self.centroids))
+        return self
+
+    def _lay_out(self, assignment):
+        # Rows of each cluster are ids[offsets[l]:offsets[l + 1]], ascending
+        self.ids = np.argsort(assignment, kind='stable')
+        self.offsets = np.searchsorted(
+            assignment[self.ids], np.arange(len(self.centroids) + 1))
+
+    def update(self, features, old_rows):
+        """
+        Re-index changed features without retraining the clusters
+
+        Kept vectors stay in their cluster and new ones join their nearest
+        centroid. Build the index again once the catalog has drifted far from
+        the vectors the clusters were trained on.
+
+        Args:
+            features: All feature vectors or EmbeddingStore after the change,
+                one row per image
+            old_rows: Per row of features, its row in the previously indexed
+                features, or -1 for a new vector
+
+        Returns:
+            The updated index
+        """
+        self.vectors = as_store(features)
+        old_rows = np.asarray(old_rows, dtype=np.intp)
+
+        old_assignment = np.empty(len(self.ids), dtype=np.intp)
+        old_assignment[self.ids] = np.repeat(
+            np.arange(len(self.centroids)), np.diff(self.offsets))
+
+        kept = old_rows >= 0
+        assignment = np.empty(len(self.vectors), dtype=np.intp)
+        assignment[kept] = old_assignment[old_rows[kept]]
+        assignment[~kept] = self._assign(
+            self.vectors[np.flatnonzero(~kept)], self.centroids)
+
+        self._lay_out(assignment)
+        return self
+
+    def search(self, query, top_k=5, n_probe=None):
+        """
+        Find the vectors most similar to a query
+
+        Args:
+            query: Feature vector of the query
+            top_k: Number of results to return
+            n_probe: Clusters to scan, the index's n_probe by default
+
+        Returns:
+            (indices, scores) of the top matches, best first
+        """
+        query = normalize(query)
+        n_lists = len(self.centroids)
+        n_probe = min(n_probe or self.n_probe, n_lists)
+
+        if n_probe < n_lists:
+            lists = top_k_indices(self.centroids @ query, n_probe)
+            # Sorted rows read the (possibly mapped) store front to back
+            rows = np.sort(np.concatenate(
+                [self.ids[self.offsets[l]:self.offsets[l + 1]] for l in lists]))
+        else:
+            rows = None
+
+        if rows is None or len(rows) < top_k:
+            # Exact fallback: every cluster probed, or too few candidates
+            scores = self.vectors.dot(query)
+            top = top_k_indices(scores, top_k)
+            return top, scores[top]
+
+        scores = self.vectors.dot(query, rows)
+        top = top_k_indices(scores, top_k)
+        return rows[top], scores[top]
+
+    def save(self, path):
+        """Save the index's clusters to an .npz file, without the vectors"""
+        np.savez(
+            path,
+            centroids=self.centroids,
+            ids=self.ids,
+            offsets=self.offsets,
+            n_probe=self.n_probe,
+        )
+
+    @classmethod
+    def load(cls, path, features):
+        """
+        Load an index saved with save
+
+        Args:
+            path: File written by save
+            features: Feature vectors or EmbeddingStore the index was built on
+        """
+        with np.load(path) as data:
+            index = cls(n_lists=len(data['centroids']), n_probe=int(data['n_probe']))
+            index.centroids = data['centroids']
+            index.ids = data['ids']
+            index.offsets = data['offsets']
+        index.vectors = as_store(features)
+        return index
+
+
+def build_index(features, kind=None, **params):
+    """
+    Build a nearest-neighbour index over feature vectors
+
+    Args:
+        features: Feature vectors, one row per image
+        kind: 'exact' or 'ivf'; by default ivf from IVF_MIN_SIZE vectors up
+        **params: Passed to the IVFIndex constructor
+
+    Returns:
+        The built index
+    """
+    if kind is None:
+        kind = 'ivf' if len(features) >= IVF_MIN_SIZE else 'exact'
+    if kind == 'exact':
+        return ExactIndex().build(features)
+    if kind == 'ivf':
+        return IVFIndex(**params).build(features)
+    raise ValueError(f"Unknown index kind {kind!r}, expected 'exact' or 'ivf'")
+
+
+def recall_at_k(index, features, queries, top_k=5, n_probe=None):
+    """
+    Fraction of the exact top_k matches an index returns, to tune n_probe
+
+    Args:
+        index: Index to evaluate
+        features: The feature vectors the index was built on
+        queries: Query vectors, one row per query
+        top_k: Number of results per query
+        n_probe: Passed to the index's search
+
+    Returns:
+        float: Mean recall over the queries
+    """
+    exact = ExactIndex().build(features)
+    hits = 0
+    for query in queries:
+        expected, _ = exact.search(query, top_k)
+        found, _ = index.search(query, top_k, n_probe=n_probe)
+        hits += len(np.intersect1d(expected, found))
+    return hits / (top_k * len(queries))